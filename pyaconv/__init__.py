@@ -1,7 +1,18 @@
 import gi
 gi.require_version('Gst', '1.0')
+gi.require_version('GstPbutils', '1.0')
 
-from gi.repository import GObject, Gst  # noqa
+# GStreamer is initialized by gst.init before the first pipeline, and the API below is
+# imported on first use, so that importing pyaconv stays cheap.
+_API = {
+    "AsyncConverter": ".converter",
+    "Converter": ".converter",
+    "Result": ".converter",
+}
 
-GObject.threads_init()
-Gst.init(None)
+
+def __getattr__(name):
+    if name in _API:
+        import importlib
+        return getattr(importlib.import_module(_API[name], __name__), name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -1,26 +1,62 @@
 from collections import deque
 import argparse
 import os
+import sys
+import tempfile
 import time
 import json
 
-from . import fsutil, logging, codecs
+from . import fsutil, logging, codecs, replaygain
+from .autoscale import Autoscaler
+from .budget import IOPRIO_CLASSES, Budget, set_priority
 from .fsutil import Path
-from .gst import Scheduler
-from .journal import Journal, VoidJournal
+from .prefetch import Prefetcher
+from .progress import Progress, format_time
 
 
-def compute_paths(args):
+def compute_paths(args, codec, multi=False):
     src_dir = Path(args.src)
     if args.dest:
         dest_dir = Path(args.dest)
+        # Each codec gets its own folder when several are encoded.
+        if multi:
+            dest_dir = dest_dir / codec
         if args.keep:
             dest_dir = dest_dir / src_dir.name
     else:
-        dest_dir = Path(args.src).with_suffix('.' + args.codec)
+        dest_dir = Path(args.src).with_suffix('.' + codec)
     return src_dir, dest_dir
 
 
+def codec_list(value):
+    names = value.split(",")
+    for name in names:
+        if name not in codecs.registry:
+            raise argparse.ArgumentTypeError("invalid codec: {} (choose from {})".format(
+                name, ", ".join(codecs.registry)))
+    if len(set(names)) != len(names):
+        raise argparse.ArgumentTypeError("codecs must not repeat")
+    return names
+
+
+def thread_count(value):
+    if value == "auto":
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid thread count: {}".format(value))
+
+
+def guard_scan(jobs, dir):
+    # The jobs are pulled from the main loop, a directory removed while it is walked
+    # must not take the watch down with it.
+    try:
+        yield from jobs
+    except OSError as e:
+        logging.warning("could not scan {}: {}", dir, e)
+
+
 def ask_folders(journal, src_dir, dest_dir, encoder):
     audio_files = []
     other_files = []
@@ -77,87 +113,331 @@ def ask_folders(journal, src_dir, dest_dir, encoder):
     return audio_files
 
 
-def walk_and_clone(journal, src_dir, dest_dir, encoder):
-    audio_files, other_files = fsutil.walk(src_dir, dest_dir, encoder.extension())
-
-    other_files = deque(journal.remove_journaled(other_files))
-    audio_files = deque(journal.remove_journaled(audio_files))
-
-    fsutil.build_tree(other_files)
-    fsutil.build_tree(audio_files)
-    fsutil.hardlink_tree(other_files, journal)
-
-    return audio_files
-
-
-def get_properties(args, props):
+def get_properties(args, props, prefix=""):
     prop_names = [p.name for p in props]
     vals = {}
     for n in prop_names:
-        vals[n] = getattr(args, n.replace('-', '_'))
+        vals[n] = getattr(args, (prefix + n).replace('-', '_'))
     return vals
 
 
-def format_time(time):
-    hours, rem = divmod(time, 3600)
-    mins, secs = divmod(rem, 60)
-    return "{:02}:{:02}:{:02}".format(int(hours), int(mins), int(secs))
-
-
 def main():
     p = argparse.ArgumentParser(prog="pyaconv", add_help=False)
     p.add_argument("src", nargs="?", default=None, help="source directory")
     p.add_argument("dest", nargs="?", default=None, help="destination directory, optional")
-    p.add_argument("-c", dest="codec", choices=list(codecs.registry.keys()),
-                   required=True, help="codec to use")
-    p.add_argument("-t", type=int, dest="threads", default=max(1, os.cpu_count() - 1), metavar="",
-                   help="number of threads, defaults to cpu count - 1")
-    p.add_argument("-i, --interactive", dest="interactive", default=False,
+    p.add_argument("-h", "--help", default=False, action="store_true",
+                   help="show this help, with the options of the codecs given with -c")
+    p.add_argument("-c", dest="codec", type=codec_list, default=None, metavar="",
+                   help="codec to use {{{}}}, several separated by commas are encoded in a "
+                   "single pass, their options are then prefixed by the codec name, e.g. "
+                   "--opus-bitrate".format(", ".join(codecs.registry)))
+    p.add_argument("-t", type=thread_count, dest="threads", default=None, metavar="",
+                   help="number of threads, defaults to cpu count - 1, "
+                   "per process with -j, divided among the processes by default, "
+                   "auto adjusts it during the run from the CPU and I/O pressure")
+    p.add_argument("-j", "--processes", type=int, dest="processes", default=None, metavar="",
+                   help="number of encoding processes, each with its own main loop")
+    p.add_argument("--serve", default=None, metavar="",
+                   help="coordinate agents (pyaconv-agent) connecting to this host:port or "
+                   "Unix socket instead of encoding locally")
+    p.add_argument("--local-agents", type=int, default=0, metavar="",
+                   help="with --serve, start that many agents on this host, without "
+                   "--serve they use a temporary Unix socket")
+    p.add_argument("-i", "--interactive", dest="interactive", default=False,
                    action="store_true", help="Use interactive mode")
     p.add_argument("--no-inc", default=False, action="store_true",
                    help="disable incremental support")
-    p.add_argument('-k, --keep', action='store_true', dest="keep", default=False, help="keep source name folder")
+    p.add_argument("--hash", default=False, action="store_true",
+                   help="hash sources to tell real changes from touched files")
+    p.add_argument("--dedup", default=False, action="store_true",
+                   help="encode sources with identical content once and link the other "
+                   "outputs to it, implies --hash")
+    p.add_argument("--fast-scan", default=False, action="store_true",
+                   help="skip source directories whose mtime did not change")
+    p.add_argument("--sniff", default=False, action="store_true",
+                   help="detect audio files without a known extension from their content")
+    p.add_argument("--scan-threads", type=int, default=None, metavar="",
+                   help="number of threads reading source directories ahead")
+    p.add_argument("--lpt", default=False, action="store_true",
+                   help="encode the longest files first to shorten the end of the run")
+    p.add_argument("--lpt-window", type=int, default=0, metavar="",
+                   help="with --lpt, only order that many jobs at a time so that encoding "
+                   "starts during the scan, 0 orders them all (default: 0)")
+    p.add_argument("--no-probe", dest="probe", default=True, action="store_false",
+                   help="with --lpt, estimate durations from file sizes instead of probing")
+    p.add_argument("--prefetch", type=int, default=0, metavar="",
+                   help="warm the sources of that many upcoming jobs in the page cache, "
+                   "for sources on a NAS or spinning disks (default: 0, off)")
+    p.add_argument("--prefetch-budget", type=int, default=512, metavar="",
+                   help="with --prefetch, megabytes of sources to hold ahead (default: 512)")
+    p.add_argument("--prefetch-read", default=False, action="store_true",
+                   help="with --prefetch, read the sources instead of advising the kernel, "
+                   "for network filesystems that ignore the advice")
+    p.add_argument("--split-cue", default=False, action="store_true",
+                   help="encode each track of a cue sheet next to an audio file as a file "
+                   "of its own")
+    p.add_argument("--passthrough", default=False, action="store_true",
+                   help="link or copy sources already in the target codec at or below the "
+                   "requested bitrate instead of encoding them")
+    p.add_argument("--replaygain", default=False, action="store_true",
+                   help="analyse the audio while encoding it and write ReplayGain track "
+                   "tags, and album tags per directory, needs the mutagen package")
+    p.add_argument("--progress", type=int, default=None, metavar="",
+                   help="report progress, throughput and ETA every N seconds")
+    p.add_argument("--stats", default=None, metavar="",
+                   help="write progress snapshots as JSON to this file")
+    p.add_argument("--debug", default=False, action="store_true",
+                   help="log debug messages, e.g. the decisions of -t auto")
+    p.add_argument("--stage", default=None, metavar="",
+                   help="encode into this local directory, e.g. on tmpfs, and move the "
+                   "files to the destination in the background")
+    p.add_argument("--stage-threads", type=int, default=2, metavar="",
+                   help="with --stage, number of threads moving files (default: 2)")
+    p.add_argument("--watch", default=False, action="store_true",
+                   help="keep running after the first pass and encode new files of the "
+                   "source directory as they land")
+    p.add_argument("--debounce", type=float, default=2.0, metavar="",
+                   help="with --watch, seconds a directory must be quiet before its new "
+                   "files are encoded (default: 2)")
+    p.add_argument("--read-limit", type=float, default=None, metavar="",
+                   help="cap the reads of the sources to that many MB/s, all workers "
+                   "together")
+    p.add_argument("--write-limit", type=float, default=None, metavar="",
+                   help="cap the writes of the outputs to that many MB/s, all workers "
+                   "together")
+    p.add_argument("--max-memory", type=int, default=None, metavar="",
+                   help="cap the number of pipelines in flight to fit their estimated "
+                   "memory in that many MB, lowers -t if needed")
+    p.add_argument("--nice", type=int, default=None, metavar="",
+                   help="run the workers at this nice value")
+    p.add_argument("--ionice", choices=list(IOPRIO_CLASSES), default=None, metavar="",
+                   help="run the workers in this I/O scheduling class {{{}}}, Linux "
+                   "only".format(", ".join(IOPRIO_CLASSES)))
+    p.add_argument("--ionice-level", type=int, choices=range(8), default=4, metavar="",
+                   help="with --ionice, priority within the class, 0 is the highest "
+                   "(default: 4)")
+    p.add_argument("--profile", default=False, action="store_true",
+                   help="measure the time spent decoding, resampling, encoding and on I/O "
+                   "and report it at the end, slows the run down")
+    p.add_argument("--profile-output", default=None, metavar="",
+                   help="with --profile, also write the report as JSON to this file")
+    p.add_argument("--plan", default=False, action="store_true",
+                   help="print what would be encoded and why, with estimates of the "
+                   "duration, output size and time, without encoding anything")
+    p.add_argument("--plan-json", default=False, action="store_true",
+                   help="like --plan, as JSON")
+    p.add_argument('-k', '--keep', action='store_true', dest="keep", default=False, help="keep source name folder")
     args, _ = p.parse_known_args()
-
-    encoder = codecs.registry[args.codec]
-    props_def = encoder.properties()
-
-    for prop in props_def:
-        prop.add_argument(p)
+    if args.codec is None:
+        if args.help or not args.src:
+            p.print_help()
+            exit()
+        p.error("the following arguments are required: -c")
+
+    multi = len(args.codec) > 1
+    props_defs = []
+    for codec in args.codec:
+        props_def = codecs.registry[codec].properties()
+        for prop in props_def:
+            prop.add_argument(p, prefix=codec + "-" if multi else "")
+        props_defs.append(props_def)
 
     args = p.parse_args()
+    if args.debug:
+        logging.set_level(logging.DEBUG)
 
-    if not args.src:
+    if args.help or not args.src:
         p.print_help()
         exit()
+    if multi and args.interactive:
+        p.error("the interactive mode only supports a single codec")
+    if args.watch and (args.interactive or args.processes):
+        p.error("the watch mode does not support --interactive or -j")
+    if args.threads == "auto" and args.processes:
+        p.error("-t auto does not support -j")
+    distributed = args.serve or args.local_agents
+    if distributed and (args.processes or args.watch or args.threads == "auto"):
+        p.error("--serve and --local-agents do not support -j, --watch or -t auto")
+    if args.replaygain and (args.processes or distributed):
+        p.error("--replaygain does not support -j, --serve or --local-agents")
+    if (args.plan or args.plan_json) and (args.interactive or args.watch or distributed):
+        p.error("--plan does not support --interactive, --watch, --serve or --local-agents")
+    limits = args.read_limit or args.write_limit or args.max_memory
+    if any(v is not None and v <= 0
+           for v in (args.read_limit, args.write_limit, args.max_memory)):
+        p.error("--read-limit, --write-limit and --max-memory must be positive")
+    if distributed and limits:
+        p.error("--serve and --local-agents do not support --read-limit, --write-limit "
+                "or --max-memory")
+    if distributed and args.stage:
+        # The agents write straight to the destinations, they may run on other hosts.
+        p.error("--serve and --local-agents do not support --stage")
+    if args.profile and (args.processes or distributed):
+        p.error("--profile does not support -j, --serve or --local-agents")
+    if args.replaygain and args.dedup:
+        p.error("--replaygain does not support --dedup, the outputs it links share tags")
+    if args.replaygain and not replaygain.available():
+        p.error("--replaygain needs the mutagen package")
+
+    # Before any thread is started, they inherit the priorities.
+    set_priority(args.nice, args.ionice, args.ionice_level)
+    budget = None
+    if limits:
+        budget = Budget(read_rate=args.read_limit and args.read_limit * 1e6,
+                        write_rate=args.write_limit and args.write_limit * 1e6,
+                        memory=args.max_memory and args.max_memory * 1e6)
+
+    # The modules using GStreamer are imported once the arguments are known to be valid,
+    # --help and argument errors do not load them.
+    from gi.repository import GLib
+    from .converter import Converter, default_props
+    from .cost import Prober, longest_first
+    from .distributed import Coordinator
+    from .gst import ProcessScheduler
+    from .plan import plan
+    from .profiling import Profiler
+    from .watch import Watcher
+
+    props = {}
+    dest_dirs = []
+    for codec, props_def in zip(args.codec, props_defs):
+        props[codec] = get_properties(args, props_def, prefix=codec + "-" if multi else "")
+        src_dir, dest_dir = compute_paths(args, codec, multi)
+        dest_dirs.append(dest_dir)
+
+    autoscaler = None
+    if args.threads == "auto":
+        autoscaler = Autoscaler(1, 2 * os.cpu_count())
+        args.threads = None
+    if args.threads is None:
+        args.threads = max(1, (os.cpu_count() - 1) // (args.processes or 1))
+
+    if args.plan or args.plan_json:
+        targets = []
+        for codec, dest_dir in zip(args.codec, dest_dirs):
+            encoder = codecs.registry[codec]
+            targets.append((codec, encoder, dict(default_props(encoder), **props[codec]),
+                            dest_dir))
+        result = plan(targets, src_dir, incremental=not args.no_inc,
+                      hash_sources=args.hash or args.dedup, fast_scan=args.fast_scan,
+                      sniff=args.sniff, scan_threads=args.scan_threads,
+                      split_cue=args.split_cue,
+                      threads=args.threads * (args.processes or 1))
+        if args.plan_json:
+            print(json.dumps(result.to_dict(), indent=2))
+        else:
+            for line in result.lines():
+                print(line)
+        return
 
-    props = get_properties(args, props_def)
-
-    src_dir, dest_dir = compute_paths(args)
-    logging.info("codec is {}", args.codec)
     logging.info("source directory is {}", src_dir.absolute())
-    logging.info("destination directory is {}", dest_dir.absolute())
-    logging.info("number of threads is {}", args.threads)
-
-    logging.info("options are:")
-    logging.info("----")
-    for name, val in props.items():
-        logging.info("{}: {}", name, val)
-    logging.info("----")
-
-    journal = VoidJournal(dest_dir) if args.no_inc else Journal(dest_dir, props)
+    if autoscaler is not None:
+        logging.info("number of threads is {}, adjusted between {} and {}", args.threads,
+                     autoscaler.minimum, autoscaler.maximum)
+    else:
+        logging.info("number of threads is {}", args.threads)
+    if args.processes:
+        logging.info("number of processes is {}", args.processes)
+
+    for codec, dest_dir in zip(args.codec, dest_dirs):
+        logging.info("codec is {}", codec)
+        logging.info("destination directory is {}", dest_dir.absolute())
+        logging.info("options are:")
+        logging.info("----")
+        for name, val in props[codec].items():
+            logging.info("{}: {}", name, val)
+        logging.info("----")
+
+    conv = Converter(args.codec, dest_dirs, props if multi else props[args.codec[0]],
+                     threads=args.threads,
+                     incremental=not args.no_inc, hash_sources=args.hash,
+                     fast_scan=args.fast_scan, sniff=args.sniff,
+                     scan_threads=args.scan_threads, split_cue=args.split_cue,
+                     passthrough=args.passthrough, dedup=args.dedup,
+                     replaygain=args.replaygain,
+                     stage_dir=Path(args.stage) if args.stage else None,
+                     stage_threads=args.stage_threads, budget=budget)
+    journal = conv.journal
 
     if args.interactive:
-        audio_files = ask_folders(journal, src_dir, dest_dir, encoder)
+        audio_files = conv.filter_jobs(ask_folders(journal, src_dir, dest_dirs[0],
+                                                   conv.encoder))
     else:
-        audio_files = walk_and_clone(journal, src_dir, dest_dir, encoder)
+        audio_files = conv.scan(src_dir)
+
+    if args.lpt:
+        prober = Prober(journal, probe=args.probe)
+        audio_files = longest_first(audio_files, prober, window=args.lpt_window)
+
+    progress = None
+    if args.progress or args.stats:
+        total = len(audio_files) if hasattr(audio_files, "__len__") else None
+        progress = Progress(total, snapshot_path=args.stats)
+    if args.prefetch:
+        audio_files = Prefetcher(audio_files, depth=args.prefetch,
+                                 budget=args.prefetch_budget << 20, read=args.prefetch_read)
+    report_interval = args.progress or 10
+
+    profiler = Profiler() if args.profile else None
+    if distributed:
+        address = args.serve or os.path.join(tempfile.gettempdir(),
+                                             "pyaconv-{}.sock".format(os.getpid()))
+        s = Coordinator(audio_files, journal, address=address,
+                        targets=[(codec, props) for codec, _, props, _ in conv.targets],
+                        local_agents=args.local_agents, threads=args.threads,
+                        progress=progress, report_interval=report_interval)
+    elif args.processes:
+        s = ProcessScheduler(audio_files, journal, encoder=conv.encoder, props=conv.props,
+                             processes=args.processes, threads=args.threads,
+                             progress=progress, report_interval=report_interval,
+                             stage_dir=conv.stage_dir, stage_threads=args.stage_threads,
+                             budget=budget)
+    else:
+        s = conv.scheduler(audio_files, progress=progress, report_interval=report_interval,
+                           keep_alive=args.watch, autoscaler=autoscaler, profiler=profiler)
+
+    watcher = None
+    if args.watch:
+        def on_change(dirs):
+            for dir, recursive in dirs:
+                if not os.path.isdir(dir):
+                    continue
+                logging.info("change in {}", dir)
+                # The directory summaries do not see files edited in place.
+                s.submit(guard_scan(conv.scan(src_dir, dir, recursive, fast_scan=False), dir))
+
+        def commit():
+            if conv.gains is not None:
+                conv.gains.finish()
+            journal.commit()
+            return True
+
+        watcher = Watcher(src_dir, on_change, debounce=args.debounce)
+        watcher.start()
+        GLib.timeout_add_seconds(5, commit)
+        logging.info("watching {}, press Ctrl-C to stop", src_dir.absolute())
 
-    s = Scheduler(audio_files, journal, encoder=encoder,
-                  props=props, threads=args.threads)
     start = time.time()
-    s.run()
-    end = time.time()
+    try:
+        s.run()
+    except KeyboardInterrupt:
+        if watcher is None:
+            raise
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        end = time.time()
+        # Agents run elsewhere with threads of their own, profiled runs are slowed down
+        # and watching mostly waits for changes, their times are not comparable.
+        if not distributed and profiler is None and watcher is None:
+            journal.record_run(end - start, args.threads * (args.processes or 1))
+        conv.close()
+        if profiler is not None:
+            profiler.report(args.profile_output)
     logging.info("time elapsed {}", format_time(end - start))
+    if args.processes and s.failed:
+        logging.error("{} files could not be encoded", s.failed)
+        sys.exit(1)
 
 
 if __name__ == '__main__':
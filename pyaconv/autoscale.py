@@ -0,0 +1,107 @@
+import os
+import time
+
+from . import logging
+
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def cpu_times():
+    """
+    Return the (busy, iowait, total) jiffies of all CPUs from /proc/stat, None where it
+    is not available.
+    """
+    try:
+        with open("/proc/stat") as f:
+            fields = [int(v) for v in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    # user nice system idle iowait irq softirq steal, guest time is part of user.
+    fields += [0] * (8 - len(fields))
+    idle, iowait = fields[3], fields[4]
+    total = sum(fields[:8])
+    return total - idle - iowait, iowait, total
+
+
+def own_times():
+    """
+    Return the CPU time used by this process, all its threads, in jiffies like cpu_times.
+    """
+    t = os.times()
+    return (t.user + t.system) * _CLOCK_TICKS
+
+
+class Autoscaler:
+
+    """
+    Decides how many workers should be active, between minimum and maximum, from the
+    pressure on the system and the throughput of the workers, in audio seconds encoded
+    per wall second. It is sampled every few seconds with decide.
+
+    Workers are added while the CPUs are not saturated or while they wait on I/O, and
+    removed when other processes take the CPUs the workers need, as measured from the busy
+    time of the host less the CPU time of this process. A worker that was added without
+    raising the throughput is removed again and the count is held for a while.
+    """
+
+    def __init__(self, minimum, maximum, *, idle_threshold=0.85, iowait_threshold=0.1,
+                 hold=6):
+        self.minimum = minimum
+        self.maximum = maximum
+        self._idle_threshold = idle_threshold
+        self._iowait_threshold = iowait_threshold
+        self._hold = hold
+        self._holding = 0
+        self._cpus = os.cpu_count() or 1
+        self._last = None
+        self._grown_from = None
+
+    def decide(self, active, encoded):
+        """
+        Return the number of workers that should be active, given the number that are and
+        the audio seconds they have encoded so far.
+        """
+        now = time.monotonic()
+        times = cpu_times()
+        own = own_times()
+        last, self._last = self._last, (now, times, encoded, own)
+        if last is None or times is None or last[1] is None:
+            return active
+        elapsed = now - last[0]
+        total = times[2] - last[1][2]
+        if elapsed <= 0 or total <= 0:
+            return active
+        busy = (times[0] - last[1][0]) / total
+        iowait = (times[1] - last[1][1]) / total
+        throughput = (encoded - last[2]) / elapsed
+        # CPUs kept busy by other processes, the busy time of the host minus our own.
+        others = max(0.0, (times[0] - last[1][0] - (own - last[3])) / total * self._cpus)
+
+        target, reason = active, None
+        grown_from, self._grown_from = self._grown_from, None
+        if grown_from is not None and throughput <= grown_from * 1.05 and active > self.minimum:
+            target = active - 1
+            reason = "the last worker did not raise throughput ({:.1f}x -> {:.1f}x)".format(
+                grown_from, throughput)
+            self._holding = self._hold
+        elif self._holding > 0:
+            self._holding -= 1
+        elif others >= 0.5 and others > self._cpus - active and active > self.minimum:
+            target = active - 1
+            reason = "the host is loaded by other processes ({:.1f} CPUs)".format(others)
+        elif iowait >= self._iowait_threshold and active < self.maximum:
+            target = active + 1
+            reason = "workers wait on I/O ({:.0%} iowait)".format(iowait)
+        elif busy < self._idle_threshold and active < self.maximum:
+            target = active + 1
+            reason = "CPUs are not saturated ({:.0%} busy)".format(busy)
+        if target > active:
+            self._grown_from = throughput
+
+        if target != active:
+            logging.info("workers {} -> {}: {}", active, target, reason)
+        else:
+            logging.debug("workers {}: {:.0%} busy, {:.0%} iowait, {:.1f} CPUs used by other "
+                          "processes, {:.1f}x realtime", active, busy, iowait, others,
+                          throughput)
+        return target
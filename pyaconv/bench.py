@@ -0,0 +1,303 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+
+from gi.repository import Gst
+
+from . import fsutil, logging, codecs
+from .converter import default_props
+from .cost import Prober, longest_first
+from .fsutil import Path
+from .gst import Scheduler, init
+from .journal import Journal, VoidJournal
+
+_CORPUS_PIPELINE = """audiotestsrc name=src wave=sine ! \
+audio/x-raw, format=S16LE, channels=2, rate={rate} ! audioconvert ! flacenc ! \
+filesink name=dest"""
+
+
+def _corpus_dirs(root, depth, fanout):
+    dirs = [root]
+    for _ in range(depth):
+        dirs = [d / "d{}".format(i) for d in dirs for i in range(fanout)]
+    return dirs
+
+
+def generate_track(path, duration, rate, freq):
+    """
+    Generate a FLAC file of the given duration with audiotestsrc. The content only
+    depends on the arguments.
+    """
+    init()
+    pipeline = Gst.parse_launch(_CORPUS_PIPELINE.format(rate=rate))
+    src = pipeline.get_by_name("src")
+    # 10 buffers per second of audio.
+    src.set_property("samplesperbuffer", rate // 10)
+    src.set_property("num-buffers", max(1, int(duration * 10)))
+    src.set_property("freq", freq)
+    pipeline.get_by_name("dest").set_property("location", str(path))
+    pipeline.set_state(Gst.State.PLAYING)
+    msg = pipeline.get_bus().timed_pop_filtered(
+        Gst.CLOCK_TIME_NONE, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    pipeline.set_state(Gst.State.NULL)
+    if msg.type == Gst.MessageType.ERROR:
+        err, _ = msg.parse_error()
+        raise RuntimeError("could not generate {}: {}".format(path, err.message))
+
+
+def generate_corpus(root, *, tracks, durations, rates, depth, fanout, seed=0):
+    """
+    Generate a deterministic library of tracks spread over a tree of the given depth and
+    fan-out, with a cover file in each leaf directory. Durations and sample rates are
+    picked from the given lists with a seeded random generator.
+    """
+    rng = random.Random(seed)
+    dirs = _corpus_dirs(root, depth, fanout)
+    for d in dirs:
+        d.mkdir(parents=True, exist_ok=True)
+        (d / "cover.jpg").write_bytes(bytes(rng.randrange(256) for _ in range(4096)))
+    for i in range(tracks):
+        path = dirs[i % len(dirs)] / "{:04}.flac".format(i)
+        generate_track(path, rng.choice(durations), rng.choice(rates),
+                       rng.uniform(110.0, 880.0))
+
+
+def bench_scan(src_dir, extension, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = sum(1 for _ in fsutil.iter_walk(src_dir, Path("/nonexistent"), extension))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {"files": count, "seconds": best}
+
+
+def bench_journal(src_dir, encoder, props):
+    """
+    Time opening a journal holding an entry for every file of src_dir and looking up all
+    of them.
+    """
+    with tempfile.TemporaryDirectory(prefix="pyaconv-bench-") as tmp:
+        dest_dir = Path(tmp)
+        pairs = [(src, dest) for src, dest, _ in
+                 fsutil.iter_walk(src_dir, dest_dir, encoder.extension())]
+        journal = Journal(dest_dir, props)
+        for src, dest in pairs:
+            journal.add(dest, src)
+        journal.close()
+
+        start = time.perf_counter()
+        journal = Journal(dest_dir, props)
+        current = sum(1 for src, dest in pairs if journal.is_current(src, dest))
+        journal.close()
+        return {"entries": current, "seconds": time.perf_counter() - start}
+
+
+def bench_encode(src_dir, encoder, props, threads, max_pipelines=None, order=None):
+    """
+    Encode every audio file of src_dir into a temporary directory and return the number of
+    files encoded and the time it took, in seconds. When given, order is applied to the
+    list of jobs before they are scheduled.
+    """
+    with tempfile.TemporaryDirectory(prefix="pyaconv-bench-") as tmp:
+        dest_dir = Path(tmp)
+        audio_files, _ = fsutil.walk(src_dir, dest_dir, encoder.extension())
+        fsutil.build_tree(audio_files)
+        count = len(audio_files)
+        if order is not None:
+            audio_files = list(order(audio_files))
+        s = Scheduler(deque(audio_files), VoidJournal(dest_dir), encoder=encoder,
+                      props=props, threads=threads, max_pipelines=max_pipelines)
+        start = time.perf_counter()
+        s.run()
+        return count, time.perf_counter() - start
+
+
+def bench_reuse(src_dir, encoder, props, threads):
+    results = {}
+    for name, max_pipelines in (("no-reuse", 0), ("reuse", None)):
+        count, elapsed = bench_encode(src_dir, encoder, props, threads, max_pipelines)
+        results[name] = count / elapsed if elapsed > 0 else 0.0
+        logging.info("{}: {} files in {:.2f}s, {:.2f} files/s", name, count, elapsed,
+                     results[name])
+    return results
+
+
+def bench_lpt(src_dir, encoder, props, threads):
+    """
+    Compare the makespan of encoding in directory order and longest first.
+    """
+    with tempfile.TemporaryDirectory(prefix="pyaconv-bench-") as tmp:
+        prober = Prober(VoidJournal(Path(tmp)))
+        durations = {}
+
+        def lpt(jobs):
+            # Probe outside of the timed section.
+            for job in jobs:
+                durations[job] = prober(job)
+            return longest_first(jobs, durations.__getitem__)
+
+        results = {}
+        for name, order in (("directory", None), ("lpt", lpt)):
+            count, elapsed = bench_encode(src_dir, encoder, props, threads, order=order)
+            results[name] = elapsed
+            logging.info("{}: {} files, makespan {:.2f}s", name, count, elapsed)
+    return results
+
+
+def _time_command(args, repeat):
+    # Run from the source tree too, pyaconv need not be installed.
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(p for p in (root, env.get("PYTHONPATH")) if p)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(args, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       check=True)
+        times.append(time.perf_counter() - start)
+    return {"best": min(times), "median": statistics.median(times)}
+
+
+def bench_startup(src_dir, codec, repeat=5):
+    """
+    Time the commands dominated by startup, each in a fresh interpreter: importing
+    pyaconv, --help, and an incremental run with nothing left to encode.
+    """
+    cli = [sys.executable, "-m", "pyaconv"]
+    with tempfile.TemporaryDirectory(prefix="pyaconv-bench-") as tmp:
+        run = cli + ["-c", codec, str(src_dir), os.path.join(tmp, "out")]
+        # The first run encodes everything, the timed ones find the journal current.
+        _time_command(run, 1)
+        results = {
+            "import": _time_command([sys.executable, "-c", "import pyaconv"], repeat),
+            "help": _time_command(cli + ["--help"], repeat),
+            "noop": _time_command(run, repeat),
+        }
+    for name, result in results.items():
+        logging.info("startup {}: best {:.3f}s, median {:.3f}s", name, result["best"],
+                     result["median"])
+    return results
+
+
+def bench_suite(src_dir, thread_counts):
+    results = {
+        "startup": bench_startup(src_dir, "opus"),
+        "scan": bench_scan(src_dir, "ogg"),
+        "journal": bench_journal(src_dir, codecs.registry["opus"],
+                                 default_props(codecs.registry["opus"])),
+        "encode": {},
+    }
+    logging.info("scan: {files} files in {seconds:.3f}s", **results["scan"])
+    logging.info("journal: {entries} entries in {seconds:.3f}s", **results["journal"])
+    for name, encoder in sorted(codecs.registry.items()):
+        results["encode"][name] = {}
+        for threads in thread_counts:
+            count, elapsed = bench_encode(src_dir, encoder, default_props(encoder), threads)
+            results["encode"][name][str(threads)] = {
+                "files": count,
+                "seconds": elapsed,
+                "files_per_second": count / elapsed if elapsed > 0 else 0.0,
+            }
+            logging.info("encode {} with {} threads: {} files in {:.2f}s", name, threads,
+                         count, elapsed)
+    return results
+
+
+def _git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(__file__),
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.decode().strip()
+
+
+def _int_list(s):
+    return [int(v) for v in s.split(",")]
+
+
+def _float_list(s):
+    return [float(v) for v in s.split(",")]
+
+
+def main():
+    p = argparse.ArgumentParser(prog="pyaconv.bench")
+    p.add_argument("src", nargs="?", default=None,
+                   help="source directory holding audio files, a synthetic corpus is "
+                   "generated when omitted")
+    p.add_argument("-m", dest="mode", choices=["suite", "reuse", "lpt", "startup"],
+                   default="suite",
+                   help="run the whole suite, compare pipeline reuse or longest first "
+                   "scheduling, or time the startup of the command line (default: suite)")
+    p.add_argument("-c", dest="codec", choices=list(codecs.registry.keys()),
+                   default="opus", help="codec to use for reuse, lpt and startup")
+    p.add_argument("-t", type=_int_list, dest="threads", default=[1, os.cpu_count()],
+                   metavar="", help="comma separated thread counts (default: 1,cpu count)")
+    p.add_argument("-o", dest="output", default=None, metavar="",
+                   help="write the JSON report to this file")
+    g = p.add_argument_group("synthetic corpus")
+    g.add_argument("--tracks", type=int, default=40, metavar="", help="number of tracks")
+    g.add_argument("--durations", type=_float_list, default=[5.0, 30.0, 120.0], metavar="",
+                   help="comma separated track durations in seconds")
+    g.add_argument("--rates", type=_int_list, default=[44100, 48000, 96000], metavar="",
+                   help="comma separated sample rates")
+    g.add_argument("--depth", type=int, default=2, metavar="", help="directory depth")
+    g.add_argument("--fanout", type=int, default=3, metavar="",
+                   help="subdirectories per directory")
+    g.add_argument("--seed", type=int, default=0, metavar="", help="random seed")
+    args = p.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="pyaconv-corpus-") as tmp:
+        if args.src is not None:
+            src_dir = Path(args.src)
+        else:
+            src_dir = Path(tmp)
+            logging.info("generating {} tracks in {}", args.tracks, src_dir)
+            generate_corpus(src_dir, tracks=args.tracks, durations=args.durations,
+                            rates=args.rates, depth=args.depth, fanout=args.fanout,
+                            seed=args.seed)
+
+        if args.mode == "suite":
+            results = bench_suite(src_dir, args.threads)
+        elif args.mode == "startup":
+            results = bench_startup(src_dir, args.codec)
+        else:
+            encoder = codecs.registry[args.codec]
+            bench = bench_reuse if args.mode == "reuse" else bench_lpt
+            results = {str(threads): bench(src_dir, encoder, default_props(encoder), threads)
+                       for threads in args.threads}
+
+    report = {
+        "mode": args.mode,
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "gstreamer": Gst.version_string(),
+        "cpu_count": os.cpu_count(),
+        "corpus": None if args.src is not None else {
+            "tracks": args.tracks,
+            "durations": args.durations,
+            "rates": args.rates,
+            "depth": args.depth,
+            "fanout": args.fanout,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import ctypes
+import os
+import platform
+import threading
+import time
+
+from . import logging
+
+# Rough resident memory of a pipeline, the decoder and its buffers, and of each encoding
+# branch with its queue, in bytes.
+PIPELINE_MEMORY = 8 << 20
+BRANCH_MEMORY = 4 << 20
+
+# I/O scheduling classes of ioprio_set(2).
+IOPRIO_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+_IOPRIO_CLASS_SHIFT = 13
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_SET = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "armv7l": 314,
+               "ppc64le": 273, "s390x": 282}
+
+
+class TokenBucket:
+
+    """
+    Lets rate bytes per second through, in bursts of up to burst bytes, a second worth by
+    default. consume blocks the calling thread until its bytes are allowed. It is called
+    from the streaming threads of the pipelines, which are then held back, and may be
+    shared by any number of them.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Going into debt keeps the callers in order, each one waits for the bytes
+            # taken before its own.
+            self._tokens -= n
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Budget:
+
+    """
+    Limits on the resources of a run. read_rate and write_rate cap the bytes per second
+    read from the sources and written to the outputs by all the pipelines, memory caps the
+    estimated memory of the pipelines in flight, in bytes. None leaves a resource alone.
+
+    The buckets are created on first use, a Budget can be pickled to the processes of a
+    ProcessScheduler, each of them given its share, see split.
+    """
+
+    def __init__(self, read_rate=None, write_rate=None, memory=None):
+        self.read_rate = read_rate
+        self.write_rate = write_rate
+        self.memory = memory
+        self._buckets = None
+
+    def __getstate__(self):
+        return dict(self.__dict__, _buckets=None)
+
+    def split(self, n):
+        """
+        Return the budget of one of n processes sharing this one.
+        """
+        def share(value):
+            return None if value is None else value / n
+        return Budget(share(self.read_rate), share(self.write_rate), share(self.memory))
+
+    def pipelines(self, encoder, props, count):
+        """
+        Return how many of count pipelines of encoder fit in the memory budget, at least one.
+        """
+        if self.memory is None:
+            return count
+        fit = max(1, int(self.memory // encoder.memory(props)))
+        if fit < count:
+            logging.info("{} pipelines fit in {:.0f} MB, down from {}", fit,
+                         self.memory / 1e6, count)
+        return min(count, fit)
+
+    def attach(self, enc):
+        """
+        Throttle the reads and writes of an encoder with the rates of the budget.
+        """
+        if self.read_rate is None and self.write_rate is None:
+            return
+        if self._buckets is None:
+            self._buckets = tuple(TokenBucket(rate) if rate is not None else None
+                                  for rate in (self.read_rate, self.write_rate))
+        read, write = self._buckets
+        enc.add_io_probes(read.consume if read is not None else None,
+                          write.consume if write is not None else None)
+
+
+def set_priority(nice=None, io_class=None, io_level=4):
+    """
+    Set the CPU nice value and the I/O scheduling class, see IOPRIO_CLASSES, of the
+    calling process. On Linux both only apply to the calling thread and the threads and
+    processes it creates afterwards, this must run before any other thread is started.
+    """
+    if nice is not None:
+        try:
+            os.setpriority(os.PRIO_PROCESS, 0, nice)
+        except OSError as e:
+            logging.warning("could not set the nice value: {}", e)
+    if io_class is not None:
+        number = _IOPRIO_SET.get(platform.machine())
+        if number is None or platform.system() != "Linux":
+            logging.warning("ionice is not supported on this platform")
+            return
+        libc = ctypes.CDLL(None, use_errno=True)
+        value = IOPRIO_CLASSES[io_class] << _IOPRIO_CLASS_SHIFT | io_level
+        if libc.syscall(number, _IOPRIO_WHO_PROCESS, 0, value) < 0:
+            err = ctypes.get_errno()
+            logging.warning("could not set the I/O priority: {}", os.strerror(err))
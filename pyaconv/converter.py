@@ -0,0 +1,434 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from . import codecs, fsutil, logging
+from .cost import Prober
+from .dedup import DedupJournal
+from .fsutil import Path
+from .gst import MultiEncoder, Scheduler
+from .journal import PASSTHROUGH, BaseJournal, ENCODED, Journal, MultiJournal, VoidJournal
+from .replaygain import ReplayGain
+
+
+def walk_and_clone(journal, src_dir, dest_dir, encoder, fast_scan=False, sniff=False,
+                   scan_threads=None, split_cue=False, base_dir=None, recursive=True,
+                   cloner=None):
+    summaries = journal if fast_scan else None
+    entries = fsutil.iter_walk(src_dir, dest_dir, encoder.extension(), base_dir=base_dir,
+                               summaries=summaries, sniff=sniff, threads=scan_threads,
+                               split_cue=split_cue, recursive=recursive)
+    return fsutil.stream_tree(entries, journal, cloner=cloner)
+
+
+def passthrough(jobs, journal, encoder, props, prober):
+    """
+    Link or copy the sources that already satisfy the properties instead of encoding them,
+    the other jobs are passed along.
+    """
+    extensions = encoder.passthrough_extensions()
+    for job in jobs:
+        # Cue tracks are only part of their source, they are always encoded.
+        if len(job) > 2:
+            yield job
+            continue
+        src, dest = job
+        if src.suffix.lower() in extensions:
+            info = prober.stream_info(src)
+            if info is not None and encoder.can_passthrough(props, info):
+                logging.info("copying {} -> {} (passthrough)", src, dest)
+                if dest.exists():
+                    dest.unlink()
+                fsutil.clone_file(src, dest)
+                journal.add(dest.absolute(), src, PASSTHROUGH)
+                continue
+        yield (src, dest)
+
+
+def walk_and_clone_targets(targets, src_dir, sniff=False, scan_threads=None, split_cue=False,
+                           base_dir=None, recursive=True, cloner=None):
+    """
+    Walk the source once for several (dest_dir, extension, journal) targets.
+    """
+    dest_dir, extension, _ = targets[0]
+    entries = fsutil.iter_walk(src_dir, dest_dir, extension, base_dir=base_dir, sniff=sniff,
+                               threads=scan_threads, split_cue=split_cue,
+                               recursive=recursive)
+    return fsutil.stream_targets(entries, dest_dir, targets, cloner=cloner)
+
+
+def default_props(encoder):
+    return {p.name: p.default for p in encoder.properties()}
+
+
+class Result:
+
+    """
+    The outcome of a job, error is None when its source was encoded to dest.
+    """
+
+    def __init__(self, src, dest, error=None):
+        self.src = src
+        self.dest = dest
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return "Result({!r}, {!r}, error={!r})".format(self.src, self.dest, self.error)
+
+
+class _ResultJournal(BaseJournal):
+
+    """
+    Passes the completed files on to the journal and keeps a Result for each of them.
+    """
+
+    def __init__(self, journal, results):
+        self._journal = journal
+        self._results = results
+
+    def add(self, path, src=None, kind=ENCODED, alias=None):
+        self._journal.add(path, src, kind, alias)
+        self._results.append(Result(src, path))
+
+    def __contains__(self, path):
+        return path in self._journal
+
+    def __len__(self):
+        return len(self._journal)
+
+
+class _Jobs:
+
+    """
+    Iterates over jobs, creating the directory of their destinations and counting them.
+    The jobs whose destination check rejects with a ValueError are not handed out, a
+    failed Result is added to results for them instead.
+    """
+
+    def __init__(self, jobs, check, results):
+        self._jobs = iter(jobs)
+        self._check = check
+        self._results = results
+        self.count = 0
+        self.exhausted = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            try:
+                job = next(self._jobs)
+            except StopIteration:
+                self.exhausted = True
+                raise
+            dest = job[1]
+            self.count += 1
+            try:
+                self._check(dest)
+            except ValueError as e:
+                logging.error("could not encode {}: {}", job[0], e)
+                self._results.append(Result(job[0], dest, str(e)))
+                continue
+            for d in dest if isinstance(dest, tuple) else (dest,):
+                if d is not None:
+                    d.parent.mkdir(parents=True, exist_ok=True)
+            return job
+
+
+class Converter:
+
+    """
+    Encodes audio files with one or several codecs. GStreamer, the journals and the
+    pipelines are kept across calls, a Converter is meant to live as long as the program
+    using it:
+
+        with Converter("opus", "music.opus", {"bitrate": 96000}) as conv:
+            for result in conv.convert_tree("music"):
+                print(result.src, result.ok)
+
+    codec is a codec name, see codecs.registry, or a list of them to encode each source
+    once with all of them. dest_dir is a directory, or a list with one per codec. With a
+    single directory and several codecs, each codec gets a subdirectory named after it.
+    props are the properties of the codec, or a dict of them per codec name for several,
+    the missing ones take their default value.
+
+    The other options match those of the command line. Incremental runs are the default,
+    with a journal in each destination directory.
+
+    Converter is not thread safe, all the calls must come from the same thread. See
+    AsyncConverter for asyncio.
+    """
+
+    def __init__(self, codec, dest_dir, props=None, *, threads=None, max_pipelines=None,
+                 incremental=True, hash_sources=False, fast_scan=False, sniff=False,
+                 scan_threads=None, split_cue=False, passthrough=False, dedup=False,
+                 replaygain=False, stage_dir=None, stage_threads=2, budget=None):
+        names = [codec] if isinstance(codec, str) else list(codec)
+        multi = len(names) > 1
+        if not isinstance(dest_dir, (list, tuple)):
+            dest_dir = [Path(dest_dir) / name if multi else Path(dest_dir) for name in names]
+        if not multi:
+            props = {names[0]: props or {}}
+        props = props or {}
+
+        self.targets = []
+        for name, dest in zip(names, dest_dir):
+            encoder = codecs.registry[name]
+            target_props = default_props(encoder)
+            target_props.update(props.get(name, {}))
+            self.targets.append((name, encoder, target_props, Path(dest)))
+
+        self._threads = threads
+        self._max_pipelines = max_pipelines
+        self._fast_scan = fast_scan and incremental
+        self._sniff = sniff
+        self._scan_threads = scan_threads
+        self._split_cue = split_cue
+        self._passthrough = passthrough and not multi
+        self._dedup = dedup and not multi
+        if replaygain and self._dedup:
+            # The album tags would be written through the links into other albums.
+            raise ValueError("replaygain cannot be combined with dedup")
+        self.stage_dir = Path(stage_dir) if stage_dir is not None else None
+        self._stage_threads = stage_threads
+        self.budget = budget
+
+        self.journals = []
+        for _, _, target_props, dest in self.targets:
+            if incremental:
+                self.journals.append(Journal(dest, target_props,
+                                             hash_sources=hash_sources or dedup))
+            else:
+                self.journals.append(VoidJournal(dest))
+
+        if multi:
+            if fast_scan:
+                logging.warning("fast scan is ignored when encoding several codecs")
+            if passthrough:
+                logging.warning("passthrough is ignored when encoding several codecs")
+            if dedup:
+                logging.warning("dedup is ignored when encoding several codecs")
+            self.journal = MultiJournal(self.journals)
+            self.encoder = MultiEncoder
+            self.props = MultiEncoder.targets_props(
+                [(enc, target_props) for _, enc, target_props, _ in self.targets],
+                replaygain=replaygain)
+            self._dest_targets = [(dest, enc.extension(), j)
+                                  for (_, enc, _, dest), j in zip(self.targets, self.journals)]
+        else:
+            self.journal = self.journals[0]
+            if self._dedup:
+                self.journal = DedupJournal(self.journal)
+            _, self.encoder, self.props, self._dest_dir = self.targets[0]
+            if replaygain:
+                self.props = dict(self.props, replaygain=True)
+
+        self.gains = ReplayGain(self.journals) if replaygain else None
+        self._results = deque()
+        self._live = None
+        # Shared by the scans, a file found by two of them is only cloned once at a time.
+        self._cloner = fsutil.Cloner()
+
+    @property
+    def multi(self):
+        return len(self.targets) > 1
+
+    def scan(self, src_dir, dir=None, recursive=True, fast_scan=None):
+        """
+        Walk dir, src_dir by default, clone its other files to the destinations and return
+        a generator of the jobs of the audio files that need encoding. Paths in the
+        destinations are relative to src_dir.
+
+        fast_scan overrides the option of the converter, a file edited in place does not
+        change the mtime of its directory, a rescan for a known change must list it.
+        """
+        if fast_scan is None:
+            fast_scan = self._fast_scan
+        src_dir = Path(src_dir)
+        dir = src_dir if dir is None else Path(dir)
+        if self.multi:
+            return walk_and_clone_targets(self._dest_targets, dir, sniff=self._sniff,
+                                          scan_threads=self._scan_threads,
+                                          split_cue=self._split_cue, base_dir=src_dir,
+                                          recursive=recursive, cloner=self._cloner)
+        jobs = walk_and_clone(self.journal, dir, self._dest_dir, self.encoder,
+                              fast_scan=fast_scan and self._fast_scan, sniff=self._sniff,
+                              scan_threads=self._scan_threads, split_cue=self._split_cue,
+                              base_dir=src_dir, recursive=recursive, cloner=self._cloner)
+        return self.filter_jobs(jobs)
+
+    def filter_jobs(self, jobs):
+        """
+        Drop the jobs handled without encoding, duplicates and passthroughs.
+        """
+        if self._dedup:
+            jobs = self.journal.dedup(jobs)
+        if self._passthrough:
+            jobs = passthrough(jobs, self.journal, self.encoder, self.props,
+                               Prober(self.journal))
+        return jobs
+
+    def scheduler(self, jobs, **kwargs):
+        """
+        Return a Scheduler encoding jobs with the codecs, journals and options of the
+        converter, the other arguments of Scheduler can be given.
+        """
+        kwargs.setdefault("threads", self._threads)
+        kwargs.setdefault("max_pipelines", self._max_pipelines)
+        kwargs.setdefault("budget", self.budget)
+        return Scheduler(jobs, kwargs.pop("journal", self.journal), encoder=self.encoder,
+                         props=self.props, stage_dir=self.stage_dir,
+                         stage_threads=self._stage_threads, replaygain=self.gains,
+                         cloner=self._cloner, **kwargs)
+
+    def _failed(self, job, error):
+        self._results.append(Result(job[0], job[1], error))
+
+    def _check_dest(self, dest):
+        # The journals only record paths inside their destination directory.
+        dests = dest if isinstance(dest, tuple) else (dest,)
+        if len(dests) != len(self.targets):
+            raise ValueError("expected {} destinations, got {}".format(len(self.targets),
+                                                                       len(dests)))
+        for d, (name, _, _, dest_dir) in zip(dests, self.targets):
+            if d is None:
+                continue
+            try:
+                Path(d).absolute().relative_to(dest_dir.absolute())
+            except ValueError:
+                raise ValueError("{} is not in the {} destination directory {}".format(
+                    d, name, dest_dir)) from None
+
+    def convert(self, jobs):
+        """
+        Encode jobs, (src, dest) pairs as yielded by scan, or a single one, and yield a
+        Result for each of them as they complete. The pipelines are kept for the next
+        call. Only one call may be in progress at a time.
+
+        The destinations must be in the destination directories. Given a single job or a
+        list, a ValueError is raised before anything is encoded otherwise, the jobs of
+        other iterables get a failed Result.
+        """
+        if isinstance(jobs, tuple):
+            jobs = [jobs]
+        if isinstance(jobs, list):
+            for job in jobs:
+                self._check_dest(job[1])
+        if self._live is None:
+            self._live = self.scheduler((), journal=_ResultJournal(self.journal, self._results),
+                                        keep_alive=True, failed_cb=self._failed)
+            self._live.start()
+        jobs = _Jobs(jobs, self._check_dest, self._results)
+        self._live.submit(jobs)
+        context = self._live.loop.get_context()
+        done = 0
+        while True:
+            while self._results:
+                done += 1
+                yield self._results.popleft()
+            if jobs.exhausted and done == jobs.count:
+                return
+            context.iteration(True)
+
+    def convert_tree(self, src_dir):
+        """
+        Encode the audio files of src_dir that need it and yield a Result for each.
+        """
+        return self.convert(self.scan(src_dir))
+
+    def convert_file(self, src, dest=None):
+        """
+        Encode a single file and return its Result. dest defaults to the name of the
+        source in the destination directory, with the extension of the codec. A ValueError
+        is raised if dest is outside of the destination directory.
+        """
+        src = Path(src)
+        if dest is None:
+            dest = tuple(d / "{}.{}".format(src.stem, enc.extension())
+                         for _, enc, _, d in self.targets)
+            if not self.multi:
+                dest = dest[0]
+        elif not isinstance(dest, tuple):
+            dest = Path(dest)
+        return next(self.convert((src, dest)))
+
+    def close(self):
+        """
+        Stop the pipelines, write the album gains and close the journals.
+        """
+        if self._live is not None:
+            self._live.stop()
+            self._live = None
+        self._cloner.close()
+        if self.gains is not None:
+            self.gains.finish()
+        self.journal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncConverter:
+
+    """
+    A Converter for asyncio. The converter lives in a thread of its own, where its main
+    loop is iterated, the event loop is never blocked. The arguments are those of
+    Converter.
+
+        async with AsyncConverter("opus", "music.opus") as conv:
+            async for result in conv.convert_tree("music"):
+                print(result.src, result.ok)
+    """
+
+    def __init__(self, *args, **kwargs):
+        # A single thread, the converter is not thread safe.
+        self._executor = ThreadPoolExecutor(1)
+        self._converter = self._executor.submit(Converter, *args, **kwargs)
+
+    async def _call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def _iterate(self, make):
+        results = await self._call(make)
+        while True:
+            result = await self._call(next, results, None)
+            if result is None:
+                return
+            yield result
+
+    async def converter(self):
+        return await asyncio.wrap_future(self._converter)
+
+    async def convert(self, jobs):
+        conv = await self.converter()
+        async for result in self._iterate(lambda: conv.convert(jobs)):
+            yield result
+
+    async def convert_tree(self, src_dir):
+        conv = await self.converter()
+        async for result in self._iterate(lambda: conv.convert_tree(src_dir)):
+            yield result
+
+    async def convert_file(self, src, dest=None):
+        conv = await self.converter()
+        return await self._call(conv.convert_file, src, dest)
+
+    async def close(self):
+        conv = await self.converter()
+        await self._call(conv.close)
+        self._executor.shutdown()
+
+    async def __aenter__(self):
+        await self.converter()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
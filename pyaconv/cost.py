@@ -0,0 +1,140 @@
+import heapq
+import itertools
+import os
+
+from gi.repository import Gst, GstPbutils
+
+from . import logging
+from .gst import init
+
+# Used to turn a size into a duration when a file cannot be probed, about the usual
+# bitrate of each format. Other extensions go by BYTES_PER_SECOND, about that of FLAC.
+BYTES_PER_SECOND = 100000
+EXTENSION_RATES = {
+    ".wav": 176400,
+    ".aif": 176400,
+    ".aiff": 176400,
+    ".flac": 100000,
+    ".ape": 90000,
+    ".wv": 90000,
+    ".mp3": 24000,
+    ".m4a": 24000,
+    ".aac": 20000,
+    ".wma": 20000,
+    ".mpc": 22000,
+    ".ogg": 20000,
+    ".oga": 20000,
+    ".opus": 16000,
+}
+
+
+def estimate_duration(src, size):
+    """
+    Estimate the duration in seconds of the source src of size bytes, from its extension.
+    """
+    rate = EXTENSION_RATES.get(os.path.splitext(str(src))[1].lower(), BYTES_PER_SECOND)
+    return size / rate
+
+
+class Prober:
+
+    """
+    Estimates the cost of encoding a source file as its duration in seconds. The duration
+    is probed with GstDiscoverer and cached in the journal, keyed by the size and mtime of
+    the source. Without probing, or when probing fails, the duration is estimated from
+    the size and the extension of the file, see estimate_duration.
+    """
+
+    def __init__(self, journal, probe=True, timeout=5):
+        self._journal = journal
+        self._probe_enabled = probe
+        self._timeout = timeout
+        # Created on the first probe, a run where every duration is cached needs none.
+        self._discoverer = None
+
+    def duration(self, src):
+        st = os.stat(str(src))
+        if not self._probe_enabled:
+            return estimate_duration(src, st.st_size)
+        duration = self._journal.cached_duration(src, st)
+        if duration is None:
+            duration = self._probe(src)
+            if duration is None:
+                return estimate_duration(src, st.st_size)
+            self._journal.cache_duration(src, st, duration)
+        return duration
+
+    def _discover(self, src):
+        if self._discoverer is None:
+            init()
+            self._discoverer = GstPbutils.Discoverer.new(self._timeout * Gst.SECOND)
+        try:
+            return self._discoverer.discover_uri(src.absolute().as_uri())
+        except Exception as e:
+            logging.warning("could not probe {}: {}", src, e)
+            return None
+
+    def _probe(self, src):
+        info = self._discover(src)
+        if info is None:
+            return None
+        return info.get_duration() / Gst.SECOND
+
+    def stream_info(self, src):
+        """
+        Describe the first audio stream of src as a dict with its container and codec caps
+        names, MPEG layer, bitrate in bits per second, channels and depth. None if the
+        file cannot be probed or has no audio.
+        """
+        info = self._discover(src)
+        if info is None:
+            return None
+        streams = info.get_audio_streams()
+        if not streams:
+            return None
+        audio = streams[0]
+        caps = audio.get_caps().get_structure(0)
+        ok, layer = caps.get_int("layer")
+        bitrate = audio.get_bitrate() or audio.get_max_bitrate()
+        duration = info.get_duration() / Gst.SECOND
+        if not bitrate and duration > 0:
+            # VBR streams often do not advertise a bitrate.
+            bitrate = int(os.stat(str(src)).st_size * 8 / duration)
+        container = None
+        topology = info.get_stream_info()
+        if isinstance(topology, GstPbutils.DiscovererContainerInfo):
+            container = topology.get_caps().get_structure(0).get_name()
+        return {
+            "container": container,
+            "codec": caps.get_name(),
+            "layer": layer if ok else None,
+            "bitrate": bitrate,
+            "channels": audio.get_channels(),
+            "depth": audio.get_depth(),
+        }
+
+    def __call__(self, job):
+        # Cue tracks know their own length, except the last one.
+        segment = job[2] if len(job) > 2 else None
+        if segment is not None and segment.length is not None:
+            return segment.length
+        duration = self.duration(job[0])
+        if segment is not None:
+            duration = max(0.0, duration - segment.start)
+        return duration
+
+
+def longest_first(jobs, cost, window=None):
+    """
+    Yield the jobs in decreasing cost order (longest processing time first), so that the
+    longest jobs do not end up alone at the end of a run. With a window, at most that many
+    jobs are buffered and the costliest of the buffer is yielded, the jobs keep streaming.
+    """
+    heap = []
+    counter = itertools.count()
+    for job in jobs:
+        heapq.heappush(heap, (-cost(job), next(counter), job))
+        if window and len(heap) >= window:
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
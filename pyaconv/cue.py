@@ -0,0 +1,105 @@
+import re
+import shlex
+
+# CD frames per second, the unit of the last field of cue sheet timestamps.
+FRAMES_PER_SECOND = 75
+
+_UNSAFE = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
+
+
+class Segment:
+
+    """
+    A time range of a source file, in seconds, to encode as a track of its own. An end of
+    None runs to the end of the file. The tags, e.g. "title", are set on the output.
+    """
+
+    def __init__(self, start, end, tags):
+        self.start = start
+        self.end = end
+        self.tags = tags
+
+    @property
+    def length(self):
+        return None if self.end is None else self.end - self.start
+
+    def __repr__(self):
+        return "Segment({!r}, {!r})".format(self.start, self.end)
+
+
+def _timestamp(value):
+    mins, secs, frames = (int(v) for v in value.split(":"))
+    return mins * 60 + secs + frames / FRAMES_PER_SECOND
+
+
+def _read(path):
+    data = path.read_bytes()
+    if data.startswith(b"\xef\xbb\xbf"):
+        data = data[3:]
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data.decode("latin-1")
+
+
+def parse(path):
+    """
+    Parse a cue sheet and return a dict mapping each FILE name to its list of tracks. A
+    track is a dict with its "number", "start" in seconds and "title", "performer" and
+    "album" when known.
+    """
+    files = {}
+    album = {}
+    tracks = None
+    track = None
+    for line in _read(path).splitlines():
+        try:
+            fields = shlex.split(line, posix=True)
+        except ValueError:
+            continue
+        if not fields:
+            continue
+        cmd = fields[0].upper()
+        if cmd == "FILE" and len(fields) >= 2:
+            tracks = files.setdefault(fields[1], [])
+            track = None
+        elif cmd == "TRACK" and tracks is not None and len(fields) >= 2:
+            track = {"number": int(fields[1]), "start": None}
+            track.update(album)
+            tracks.append(track)
+        elif cmd in ("TITLE", "PERFORMER") and len(fields) >= 2:
+            key = "title" if cmd == "TITLE" else "performer"
+            if track is None:
+                album["album" if key == "title" else key] = fields[1]
+            else:
+                track[key] = fields[1]
+        elif cmd == "INDEX" and track is not None and len(fields) >= 3:
+            if int(fields[1]) == 1:
+                track["start"] = _timestamp(fields[2])
+    return {name: [t for t in tracks if t["start"] is not None]
+            for name, tracks in files.items()}
+
+
+def segments(tracks):
+    """
+    Turn the tracks of a file into segments, each running up to the start of the next.
+    The first one starts with the file, so that nothing before it is lost.
+    """
+    out = []
+    for i, track in enumerate(tracks):
+        start = track["start"] if i > 0 else 0.0
+        end = tracks[i + 1]["start"] if i + 1 < len(tracks) else None
+        tags = {k: v for k, v in track.items() if k != "start"}
+        out.append(Segment(start, end, tags))
+    return out
+
+
+def track_name(segment):
+    """
+    Return the file name, without extension, of the track of a segment.
+    """
+    number = segment.tags["number"]
+    title = segment.tags.get("title")
+    if not title:
+        return "{:02}".format(number)
+    return "{:02} - {}".format(number, _UNSAFE.sub("_", title).strip())
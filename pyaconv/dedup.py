@@ -0,0 +1,108 @@
+import os
+
+from . import fsutil, logging
+from .journal import ALIAS, ENCODED, BaseJournal
+
+
+class DedupJournal(BaseJournal):
+
+    """
+    Wraps a Journal to encode sources with identical content only once. dedup filters the
+    audio jobs by the content hash of their source: the first job of each hash is encoded,
+    the output of the others is hard linked, or copied, from it and journaled as an ALIAS
+    of it. Outputs of previous runs are found through the hashes recorded in the journal,
+    which must be created with hash_sources.
+
+    The copies of an output encoded during the run are made as soon as it is journaled.
+    If it fails to encode, they are not journaled and are tried again on the next run.
+    """
+
+    def __init__(self, journal):
+        self._journal = journal
+        # digest -> output of the job encoding it in this run
+        self._outputs = {}
+        # output -> [(src, dest), ...] waiting for it
+        self._waiting = {}
+
+    def dedup(self, jobs):
+        for job in jobs:
+            # Cue tracks are only part of their source.
+            if len(job) > 2:
+                yield job
+                continue
+            src, dest = job
+            digest = self._journal.source_hash(src)
+            output = self._outputs.get(digest)
+            if output is not None:
+                logging.info("{} has the same content as the source of {}", src, output)
+                self._waiting.setdefault(output, []).append((src, dest))
+                continue
+            output = self._journal.find_output(digest)
+            if output is not None and output != dest.absolute():
+                self._link(output, src, dest)
+                continue
+            self._outputs[digest] = dest.absolute()
+            yield job
+
+    def _link(self, output, src, dest):
+        logging.info("linking {} -> {} (same content as {})", src, dest, output)
+        try:
+            if dest.exists():
+                os.unlink(str(dest))
+            fsutil.clone_file(output, dest)
+        except OSError as e:
+            logging.error("could not link {} to {}: {}", output, dest, e)
+            return
+        self._journal.add(dest.absolute(), src, ALIAS, alias=output)
+
+    def add(self, path, src=None, kind=ENCODED, alias=None):
+        self._journal.add(path, src, kind, alias)
+        for src, dest in self._waiting.pop(path.absolute(), ()):
+            self._link(path.absolute(), src, dest)
+
+    def is_current(self, src, dest):
+        return self._journal.is_current(src, dest)
+
+    def check(self, src, dest):
+        return self._journal.check(src, dest)
+
+    def cached_duration(self, src, st):
+        return self._journal.cached_duration(src, st)
+
+    def cache_duration(self, src, st, duration):
+        self._journal.cache_duration(src, st, duration)
+
+    def source_hash(self, src):
+        return self._journal.source_hash(src)
+
+    def find_output(self, digest):
+        return self._journal.find_output(digest)
+
+    def unchanged_dir(self, path, mtime_ns):
+        return self._journal.unchanged_dir(path, mtime_ns)
+
+    def record_dir(self, path, mtime_ns, subdirs):
+        self._journal.record_dir(path, mtime_ns, subdirs)
+
+    def record_run(self, seconds, threads):
+        self._journal.record_run(seconds, threads)
+
+    def runs(self, limit):
+        return self._journal.runs(limit)
+
+    def commit(self):
+        self._journal.commit()
+
+    def close(self):
+        for output in self._waiting:
+            logging.warning("{} was not encoded, its copies were not made", output)
+        self._journal.close()
+
+    def __contains__(self, path):
+        return path in self._journal
+
+    def __len__(self):
+        return len(self._journal)
+
+    def remove_journaled(self, pairs):
+        return self._journal.remove_journaled(pairs)
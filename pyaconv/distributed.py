@@ -0,0 +1,529 @@
+"""
+Distributed encoding. A Coordinator owns the journal and the jobs and hands them out to
+Agents, on this host or others, that run a Scheduler against the same storage. Paths are
+sent as is, sources and destinations must be mounted at the same place everywhere.
+
+The protocol is JSON, one message per line. An agent says hello and gets the codecs and
+their properties. It then asks for as many jobs as it wants and reports each of them as
+done or failed, and sends heartbeats. The coordinator answers with jobs, and with none
+once every job is done. Jobs of agents that disconnect or stop sending heartbeats are
+given to the others.
+
+Heartbeats are acknowledged. An agent that hears nothing from the coordinator for half
+of the heartbeat timeout, or loses the connection, aborts its pipelines and pending
+moves, before its jobs can be handed out again: two agents never write the same file.
+There is no authentication, use it on trusted networks only.
+"""
+import argparse
+from collections import deque
+import itertools
+import json
+import multiprocessing
+import os
+import selectors
+import socket
+import time
+
+from gi.repository import GLib
+
+from . import codecs, logging
+from .cue import Segment
+from .fsutil import Path
+from .gst import MultiEncoder, Scheduler
+from .journal import ENCODED, BaseJournal
+
+
+def parse_address(value):
+    """
+    Return the (family, address) of a "host:port" TCP address or a Unix socket path.
+    """
+    if "/" in value or ":" not in value:
+        return socket.AF_UNIX, value
+    host, _, port = value.rpartition(":")
+    return socket.AF_INET, (host or "0.0.0.0", int(port))
+
+
+def format_address(family, address):
+    if family == socket.AF_UNIX:
+        return address
+    return "{}:{}".format(*address[:2])
+
+
+def _encoder_props(targets):
+    if len(targets) == 1:
+        name, props = targets[0]
+        return codecs.registry[name], props
+    return MultiEncoder, MultiEncoder.targets_props(
+        [(codecs.registry[name], props) for name, props in targets])
+
+
+class _JobPath(Path):
+
+    """
+    The destination of a job of an agent, carrying the id the coordinator gave the job.
+    """
+
+    job_id = None
+
+
+class _JobDests(tuple):
+
+    """
+    The destinations of a job of several targets, with the id of the job.
+    """
+
+    job_id = None
+
+
+def _encode_job(id, job):
+    src, dest = job[0], job[1]
+    if isinstance(dest, tuple):
+        dest = [None if d is None else str(d.absolute()) for d in dest]
+    else:
+        dest = str(dest.absolute())
+    msg = {"type": "job", "id": id, "src": str(src.absolute()), "dest": dest}
+    if len(job) > 2:
+        segment = job[2]
+        msg["segment"] = [segment.start, segment.end, segment.tags]
+    return msg
+
+
+def _decode_job(msg):
+    # The journal and the failure callback only get the destination of a job, it holds
+    # the id. Destinations are not unique, e.g. a.flac and a.mp3 both go to a.ogg.
+    dest = msg["dest"]
+    if isinstance(dest, list):
+        dest = _JobDests(None if d is None else Path(d) for d in dest)
+    else:
+        dest = _JobPath(dest)
+    dest.job_id = msg["id"]
+    job = (Path(msg["src"]), dest)
+    if "segment" in msg:
+        job += (Segment(*msg["segment"]),)
+    return job
+
+
+class _Channel:
+
+    """
+    Newline delimited JSON messages over a socket.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._buffer = b""
+
+    def send(self, msg):
+        self.sock.sendall(json.dumps(msg).encode() + b"\n")
+
+    def receive(self):
+        """
+        Read what is available and return the complete messages, None once the peer
+        has closed the connection.
+        """
+        data = self.sock.recv(64 * 1024)
+        if not data:
+            return None
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b"\n")
+        return [json.loads(line.decode()) for line in lines if line]
+
+    def close(self):
+        self.sock.close()
+
+
+class _RemoteAgent:
+
+    def __init__(self, sock, name):
+        self.channel = _Channel(sock)
+        self.name = name
+        self.jobs = {}
+        self.wanted = 0
+        self.last_seen = time.monotonic()
+
+
+class Coordinator:
+
+    """
+    Hands out the jobs of the queue to the agents connecting to address and journals the
+    completed ones. targets is the list of (codec name, props) to encode with. Jobs of
+    agents silent for heartbeat_timeout seconds or disconnected are queued again.
+
+    With local_agents, that many agents are started on this host, each with threads
+    workers, which is handy for testing.
+    """
+
+    def __init__(self, queue, journal, *, address, targets, heartbeat_timeout=30,
+                 local_agents=0, threads=None, max_pipelines=None, progress=None,
+                 report_interval=10):
+        self._jobs = iter(queue)
+        self._journal = journal
+        self._address = parse_address(address)
+        self._targets = targets
+        self._heartbeat_timeout = heartbeat_timeout
+        self._local_agents = local_agents
+        self._threads = threads
+        self._max_pipelines = max_pipelines
+        self._progress = progress
+        self._report_interval = report_interval
+        self._requeued = deque()
+        self._exhausted = False
+        self._ids = itertools.count()
+        self._agents = []
+        self._selector = None
+
+    def _listen(self):
+        family, address = self._address
+        listener = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_UNIX:
+            try:
+                os.unlink(address)
+            except FileNotFoundError:
+                pass
+        else:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(address)
+        listener.listen()
+        return listener
+
+    def run(self):
+        listener = self._listen()
+        family = self._address[0]
+        address = format_address(family, listener.getsockname())
+        logging.info("waiting for agents on {}", address)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(listener, selectors.EVENT_READ)
+
+        # Agents initialize their own GStreamer, forking an initialized one is unsafe.
+        ctx = multiprocessing.get_context("spawn")
+        procs = [ctx.Process(target=run_agent, args=(address,),
+                             kwargs={"threads": self._threads,
+                                     "max_pipelines": self._max_pipelines})
+                 for _ in range(self._local_agents)]
+        for proc in procs:
+            proc.start()
+
+        last_report = time.monotonic()
+        try:
+            while True:
+                for key, _ in self._selector.select(timeout=1.0):
+                    if key.data is None:
+                        self._accept(listener)
+                    else:
+                        self._receive(key.data)
+                now = time.monotonic()
+                for agent in list(self._agents):
+                    if now - agent.last_seen > self._heartbeat_timeout:
+                        logging.warning("agent {} timed out", agent.name)
+                        self._drop(agent)
+                self._dispatch()
+                if self._done():
+                    break
+                if procs and not self._agents and not any(p.is_alive() for p in procs):
+                    raise RuntimeError("the local agents exited")
+                if (self._progress is not None and
+                        now - last_report >= self._report_interval):
+                    self._progress.report()
+                    last_report = now
+            if self._progress is not None:
+                self._progress.report()
+        finally:
+            for agent in list(self._agents):
+                try:
+                    agent.channel.send({"type": "none"})
+                except OSError:
+                    pass
+                self._drop(agent)
+            self._selector.close()
+            listener.close()
+            if family == socket.AF_UNIX:
+                os.unlink(address)
+            for proc in procs:
+                proc.join()
+
+    def _accept(self, listener):
+        sock, peer = listener.accept()
+        # A stuck agent must not block the coordinator on a send.
+        sock.settimeout(10)
+        agent = _RemoteAgent(sock, str(peer) or "local")
+        self._agents.append(agent)
+        self._selector.register(sock, selectors.EVENT_READ, agent)
+
+    def _drop(self, agent):
+        if agent not in self._agents:
+            return
+        self._agents.remove(agent)
+        self._selector.unregister(agent.channel.sock)
+        agent.channel.close()
+        if agent.jobs:
+            logging.warning("queuing {} jobs of agent {} again", len(agent.jobs), agent.name)
+        for id, job in agent.jobs.items():
+            self._requeued.append(job)
+            if self._progress is not None:
+                self._progress.cancel(id)
+
+    def _receive(self, agent):
+        try:
+            messages = agent.channel.receive()
+        except (OSError, ValueError) as e:
+            logging.warning("agent {} failed: {}", agent.name, e)
+            messages = None
+        if messages is None:
+            self._drop(agent)
+            return
+        agent.last_seen = time.monotonic()
+        for msg in messages:
+            if not self._handle(agent, msg):
+                logging.warning("agent {} sent an invalid message: {!r}", agent.name, msg)
+                self._drop(agent)
+                return
+            if agent not in self._agents:
+                # Dropped as a reply could not be sent.
+                return
+
+    def _handle(self, agent, msg):
+        # Messages come from the network, False if one is not understood.
+        kind = msg.get("type") if isinstance(msg, dict) else None
+        if kind == "hello":
+            agent.name = msg.get("name", agent.name)
+            logging.info("agent {} connected with {} threads", agent.name,
+                         msg.get("threads"))
+            self._send(agent, {"type": "config", "targets": self._targets,
+                               "lease": self._heartbeat_timeout})
+        elif kind == "heartbeat":
+            self._send(agent, {"type": "ack"})
+        elif kind == "want":
+            count = msg.get("count")
+            if not isinstance(count, int) or count < 0:
+                return False
+            agent.wanted += count
+        elif kind in ("done", "failed"):
+            id = msg.get("id")
+            if not isinstance(id, int):
+                return False
+            job = agent.jobs.pop(id, None)
+            if job is None:
+                return True
+            if kind == "done":
+                self._journal.add(job[1], job[0], msg.get("kind", ENCODED))
+            else:
+                logging.error("agent {} failed to encode {}: {}", agent.name, job[0],
+                              msg.get("error"))
+            if self._progress is not None:
+                self._progress.finish(id)
+        else:
+            return False
+        return True
+
+    def _send(self, agent, msg):
+        try:
+            agent.channel.send(msg)
+        except OSError as e:
+            logging.warning("agent {} failed: {}", agent.name, e)
+            self._drop(agent)
+            return False
+        return True
+
+    def _take(self):
+        if self._requeued:
+            return self._requeued.popleft()
+        if self._exhausted:
+            return None
+        job = next(self._jobs, None)
+        if job is None:
+            self._exhausted = True
+            if self._progress is not None:
+                self._progress.exhausted()
+        return job
+
+    def _dispatch(self):
+        for agent in list(self._agents):
+            while agent.wanted > 0:
+                job = self._take()
+                if job is None:
+                    return
+                id = next(self._ids)
+                agent.jobs[id] = job
+                agent.wanted -= 1
+                if self._progress is not None:
+                    self._progress.start(id, job[0])
+                if not self._send(agent, _encode_job(id, job)):
+                    break
+
+    def _done(self):
+        return (self._exhausted and not self._requeued and
+                not any(agent.jobs for agent in self._agents))
+
+
+class _AgentJournal(BaseJournal):
+
+    """
+    Journal of an agent, completed files are reported to the coordinator.
+    """
+
+    def __init__(self, agent):
+        self._agent = agent
+
+    def add(self, path, src=None, kind=ENCODED, alias=None):
+        self._agent.done(path, kind)
+
+    def __contains__(self, item):
+        return False
+
+    def __len__(self):
+        return 0
+
+
+class Agent:
+
+    """
+    Connects to a Coordinator and encodes the jobs it hands out with a Scheduler, keeping
+    all of its workers busy plus one job ahead.
+    """
+
+    def __init__(self, address, *, threads=None, max_pipelines=None, stage_dir=None,
+                 heartbeat=5):
+        if threads is None:
+            threads = max(1, os.cpu_count() - 1)
+        self._address = parse_address(address)
+        self._threads = threads
+        self._max_pipelines = max_pipelines
+        self._stage_dir = stage_dir
+        self._heartbeat = heartbeat
+        self._channel = None
+        self._scheduler = None
+        # job id -> job
+        self._jobs = {}
+        self._closing = False
+        self._lease = None
+        self._last_heard = time.monotonic()
+
+    def _connect(self):
+        family, address = self._address
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.connect(address)
+        return _Channel(sock)
+
+    def run(self):
+        self._channel = self._connect()
+        self._channel.send({"type": "hello", "name": "{}:{}".format(socket.gethostname(),
+                                                                    os.getpid()),
+                            "threads": self._threads})
+        config = None
+        while config is None:
+            messages = self._channel.receive()
+            if messages is None:
+                raise ConnectionError("the coordinator closed the connection")
+            config = next((m for m in messages if m["type"] == "config"), None)
+        encoder, props = _encoder_props(config["targets"])
+        self._lease = config.get("lease")
+        self._last_heard = time.monotonic()
+
+        self._scheduler = Scheduler((), _AgentJournal(self), encoder=encoder, props=props,
+                                    threads=self._threads,
+                                    max_pipelines=self._max_pipelines, keep_alive=True,
+                                    stage_dir=self._stage_dir, failed_cb=self._failed)
+        sources = [
+            GLib.io_add_watch(self._channel.sock.fileno(), GLib.PRIORITY_DEFAULT,
+                              GLib.IOCondition.IN | GLib.IOCondition.HUP, self._read),
+            GLib.timeout_add_seconds(self._heartbeat, self._send_heartbeat),
+        ]
+        self._want(self._threads + 1)
+        try:
+            self._scheduler.run()
+        finally:
+            for source in sources:
+                GLib.source_remove(source)
+            self._channel.close()
+
+    def _send(self, msg):
+        try:
+            self._channel.send(msg)
+        except OSError as e:
+            self._abort("lost the coordinator: {}".format(e))
+
+    def _abort(self, reason):
+        # The coordinator hands our jobs out again, stop writing to their destinations.
+        if self._jobs:
+            logging.error("{}, aborting {} jobs", reason, len(self._jobs))
+        else:
+            logging.error("{}", reason)
+        self._jobs.clear()
+        self._scheduler.abort()
+
+    def _want(self, count):
+        self._send({"type": "want", "count": count})
+
+    def _send_heartbeat(self):
+        # Well before the coordinator gives up on us and requeues the jobs.
+        if self._lease and time.monotonic() - self._last_heard > self._lease / 2:
+            self._abort("no answer from the coordinator for {:.0f}s".format(
+                time.monotonic() - self._last_heard))
+            return True
+        self._send({"type": "heartbeat"})
+        return True
+
+    def _read(self, fd, condition):
+        try:
+            messages = self._channel.receive()
+        except (OSError, ValueError) as e:
+            self._abort("lost the coordinator: {}".format(e))
+            return False
+        if messages is None:
+            self._abort("the coordinator closed the connection")
+            return False
+        self._last_heard = time.monotonic()
+        jobs = []
+        for msg in messages:
+            if msg["type"] == "job":
+                job = _decode_job(msg)
+                self._jobs[msg["id"]] = job
+                jobs.append(job)
+            elif msg["type"] == "none":
+                self._closing = True
+        if jobs:
+            self._scheduler.submit(jobs)
+        self._check_done()
+        return True
+
+    def _check_done(self):
+        if self._closing and not self._jobs:
+            self._scheduler.quit()
+
+    def done(self, dest, kind):
+        if self._jobs.pop(dest.job_id, None) is None:
+            return
+        self._send({"type": "done", "id": dest.job_id, "kind": kind})
+        self._want(1)
+        self._check_done()
+
+    def _failed(self, job, error):
+        if self._jobs.pop(job[1].job_id, None) is None:
+            return
+        self._send({"type": "failed", "id": job[1].job_id, "error": str(error)})
+        self._want(1)
+        self._check_done()
+
+
+def run_agent(address, **kwargs):
+    Agent(address, **kwargs).run()
+
+
+def main():
+    p = argparse.ArgumentParser(prog="pyaconv-agent",
+                                description="encode the jobs of a pyaconv coordinator")
+    p.add_argument("address", help="host:port or Unix socket path of the coordinator")
+    p.add_argument("-t", type=int, dest="threads", default=None, metavar="",
+                   help="number of threads, defaults to cpu count - 1")
+    p.add_argument("--stage", default=None, metavar="",
+                   help="encode into this local directory and move the files to the "
+                   "destination in the background")
+    p.add_argument("--heartbeat", type=int, default=5, metavar="",
+                   help="seconds between heartbeats (default: 5)")
+    args = p.parse_args()
+    run_agent(args.address, threads=args.threads,
+              stage_dir=Path(args.stage) if args.stage else None, heartbeat=args.heartbeat)
+
+
+if __name__ == '__main__':
+    main()
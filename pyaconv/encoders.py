@@ -0,0 +1,169 @@
+from gi.repository import Gst
+
+from .gst import BaseEncoder, Property, PropertyEnum, PropertyRange
+
+_OPUS_BRANCH = """opusenc name=enc{n} ! oggmux ! filesink name=dest{n}"""
+
+
+class OpusEncoder(BaseEncoder):
+
+    def apply_props(self, props, enc):
+        enc.set_property("bitrate", props["bitrate"])
+        Gst.util_set_object_arg(enc, "bitrate-type", props["bitrate-type"])
+        Gst.util_set_object_arg(enc, "audio-type", props["audio-type"])
+
+    @classmethod
+    def properties(cls):
+        return (
+            Property("bitrate", type=int, default=64000, help="bitrate is bits per second"),
+            PropertyEnum("bitrate-type", values=["cbr", "vbr", "constrained_vbr"],
+                         default="vbr",
+                         help="bitrate type"),
+            PropertyEnum("audio-type", values=["generic", "voice"],
+                         default="generic", help="audio type to optimize for"),
+        )
+
+    @classmethod
+    def extension(cls):
+        return "ogg"
+
+    @classmethod
+    def branch(cls, props, n=""):
+        return _OPUS_BRANCH.format(n=n)
+
+    @classmethod
+    def passthrough_extensions(cls):
+        return (".opus", ".ogg")
+
+    @classmethod
+    def can_passthrough(cls, props, info):
+        return (info["container"] == "application/ogg" and
+                info["codec"] == "audio/x-opus" and
+                0 < info["bitrate"] <= props["bitrate"])
+
+    @classmethod
+    def bitrate(cls, props):
+        return props["bitrate"]
+
+
+# Approximate average bitrate in kbit/s of each LAME VBR quality.
+_MP3_VBR_BITRATES = (245, 225, 190, 175, 165, 130, 115, 100, 85, 65, 65)
+
+_MP3_BRANCH_ID3 = """lamemp3enc name=enc{n} ! id3mux ! filesink name=dest{n}"""
+
+_MP3_BRANCH_ID3V2 = """lamemp3enc name=enc{n} ! id3v2mux ! filesink name=dest{n}"""
+
+
+class Mp3Encoder(BaseEncoder):
+
+    def apply_props(self, props, enc):
+        if props["bitrate"]:
+            Gst.util_set_object_arg(enc, "target", "bitrate")
+            enc.set_property("cbr", True)
+            enc.set_property("bitrate", props["bitrate"])
+        else:
+            Gst.util_set_object_arg(enc, "target", "quality")
+            enc.set_property("cbr", props["cbr"])
+            enc.set_property("quality", props["quality"])
+
+        enc.set_property("mono", props["mono"])
+        Gst.util_set_object_arg(enc, "encoding-engine-quality", props["encoding-engine-quality"])
+
+    @classmethod
+    def properties(cls):
+        # gst-inspect-1.0 lamemp3enc
+        return (
+            PropertyRange("bitrate", min=8, max=320, default=None,
+                          help="bitrate is kilobits per second (implies CBR)"),
+            PropertyRange("quality", min=0, max=10, default=4,
+                          help="quality 0 being best, 10 being worst"),
+            Property("cbr", type=bool, default=False, help="CBR encoding"),
+            PropertyEnum("encoding-engine-quality", values=["fast", "standard", "high"],
+                         default="high", help="quality/speed of the encoding engine"),
+            Property("mono", type=bool, default=False, help="mono encoding"),
+            Property("id3v2", type=bool, default=False, help="Use id3v2 tags")
+        )
+
+    @classmethod
+    def extension(cls):
+        return "mp3"
+
+    @classmethod
+    def branch(cls, props, n=""):
+        if props["id3v2"]:
+            return _MP3_BRANCH_ID3V2.format(n=n)
+        return _MP3_BRANCH_ID3.format(n=n)
+
+    @classmethod
+    def passthrough_extensions(cls):
+        return (".mp3",)
+
+    @classmethod
+    def can_passthrough(cls, props, info):
+        if info["codec"] != "audio/mpeg" or info["layer"] != 3:
+            return False
+        if props["mono"] and info["channels"] != 1:
+            return False
+        kbps = props["bitrate"] or _MP3_VBR_BITRATES[props["quality"]]
+        return 0 < info["bitrate"] <= kbps * 1000
+
+    @classmethod
+    def bitrate(cls, props):
+        return (props["bitrate"] or _MP3_VBR_BITRATES[props["quality"]]) * 1000
+
+
+_FLAC_BRANCH_16 = """audio/x-raw, format=S16LE ! flacenc name=enc{n} ! \
+filesink name=dest{n}"""
+
+_FLAC_BRANCH_24 = """audio/x-raw, format=S24LE ! flacenc name=enc{n} ! \
+filesink name=dest{n}"""
+
+_FLAC_BRANCH_32 = """audio/x-raw, format=S24_32LE ! flacenc name=enc{n} ! \
+filesink name=dest{n}"""
+
+
+class FlacEncoder(BaseEncoder):
+
+    def apply_props(self, props, enc):
+        enc.set_property("escape-coding", True)
+        enc.set_property("exhaustive-model-search", True)
+        Gst.util_set_object_arg(enc, "quality", props["quality"])
+
+    @classmethod
+    def properties(cls):
+        return (
+            PropertyEnum("bit-depth", values=[16, 24, 32], type=int,
+                         default=16, help="bit depth per sample"),
+            PropertyEnum("quality", values=[str(q) for q in range(0, 9)],
+                         default="5", help="compression quality: 0 fastest ; 8 best"),
+        )
+
+    @classmethod
+    def extension(cls):
+        return "flac"
+
+    @classmethod
+    def branch(cls, props, n=""):
+        depth = props["bit-depth"]
+        if depth == 16:
+            return _FLAC_BRANCH_16.format(n=n)
+        elif depth == 24:
+            return _FLAC_BRANCH_24.format(n=n)
+        elif depth == 32:
+            return _FLAC_BRANCH_32.format(n=n)
+        else:
+            raise ValueError("invalid bit depth, expected 16, 24 or 32")
+
+    @classmethod
+    def passthrough_extensions(cls):
+        return (".flac",)
+
+    @classmethod
+    def can_passthrough(cls, props, info):
+        # Only the compression level would differ, the audio is the same.
+        return info["codec"] == "audio/x-flac" and info["depth"] == props["bit-depth"]
+
+    @classmethod
+    def bitrate(cls, props):
+        # Lossless, assume 44.1 kHz stereo compressing to about 60%.
+        return int(2 * 44100 * props["bit-depth"] * 0.6)
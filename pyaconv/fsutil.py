@@ -1,8 +1,14 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import mimetypes
 import os
 import pathlib
 import errno
 import shutil
+import stat
+
+from . import cue, logging
 
 _SuperPath = type(pathlib.Path())
 
@@ -13,14 +19,7 @@ class Path(_SuperPath):
         return Path(os.path.abspath(str(self)))
 
 
-def walk(src_dir, dest_dir, extension, base_dir=None):
-    """
-    Recursively walks the source directory and categorizes files as audio or
-    other.
-
-    Returns
-    """
-    base_dir = base_dir or src_dir
+def _check_dirs(src_dir, dest_dir):
     if not src_dir.exists():
         raise ValueError("source does not exist")
     if not src_dir.is_dir():
@@ -29,40 +28,495 @@ def walk(src_dir, dest_dir, extension, base_dir=None):
     if dest_dir.exists() and not dest_dir.is_dir():
         raise ValueError("destination is not a directory")
 
-    audio_files = list()
-    other_files = list()
 
-    def walker(dir):
-        for f in dir.iterdir():
+@functools.lru_cache(maxsize=None)
+def _audio_extensions():
+    mimetypes.init()
+    return frozenset(ext for ext, kind in mimetypes.types_map.items()
+                     if kind.startswith("audio/"))
+
+
+def _known_extension(ext):
+    return ext in mimetypes.types_map or ext.lower() in mimetypes.types_map
+
+
+def is_audio_name(name):
+    """
+    Classify a file name the same way mimetypes.guess_type does, from a precomputed table
+    of audio extensions. Returns None when the extension is unknown.
+    """
+    audio = _audio_extensions()
+    base, ext = os.path.splitext(name)
+    while ext.lower() in mimetypes.suffix_map:
+        base, ext = os.path.splitext(base + mimetypes.suffix_map[ext.lower()])
+    # Compressed files are typed after their inner extension, e.g. "song.flac.gz".
+    if ext in mimetypes.encodings_map or ext.lower() in mimetypes.encodings_map:
+        base, ext = os.path.splitext(base)
+    if ext in audio or ext.lower() in audio:
+        return True
+    if _known_extension(ext):
+        return False
+    return None
+
+
+# Leading bytes of common audio containers, as (offset, magic) pairs.
+_AUDIO_MAGIC = (
+    (0, b"fLaC"),
+    (0, b"OggS"),
+    (0, b"ID3"),
+    (0, b"MAC "),
+    (0, b"wvpk"),
+    (0, b"TTA1"),
+    (0, b"#!AMR"),
+    (8, b"WAVE"),
+    (8, b"AIFF"),
+    (8, b"AIFC"),
+    (4, b"ftypM4A"),
+)
+
+
+def sniff_audio(path):
+    """
+    Look at the first bytes of a file to tell whether it holds audio.
+    """
+    try:
+        with open(str(path), 'rb') as f:
+            head = f.read(16)
+    except OSError:
+        return False
+    if any(head[off:off + len(magic)] == magic for off, magic in _AUDIO_MAGIC):
+        return True
+    # MPEG audio frame sync, for MP3 files without an ID3 tag.
+    return len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0
+
+
+def _list_dir(path):
+    with os.scandir(path) as it:
+        return list(it)
+
+
+def _cue_segments(entries):
+    """
+    Map the audio file names of a directory to the segments of the cue sheets next to
+    them. Only files holding several tracks are split. A cue sheet often refers to the
+    original rip, e.g. a .wav file, so files are also matched on their stem.
+    """
+    by_name = {}
+    for entry in entries:
+        if entry.name.lower().endswith(".cue") and entry.is_file():
+            try:
+                files = cue.parse(Path(entry.path))
+            except (OSError, ValueError) as e:
+                logging.warning("could not read cue sheet {}: {}", entry.path, e)
+                continue
+            for name, tracks in files.items():
+                if len(tracks) > 1:
+                    by_name[name] = cue.segments(tracks)
+    if not by_name:
+        return by_name
+    by_stem = {os.path.splitext(name)[0]: segs for name, segs in by_name.items()}
+    return {entry.name: by_name.get(entry.name) or by_stem.get(os.path.splitext(entry.name)[0])
+            for entry in entries}
 
-            if f.is_file():
-                kind, _ = mimetypes.guess_type(f.absolute().as_uri())
-                clone_path = dest_dir / f.relative_to(base_dir)
-                if kind is not None and kind.startswith("audio/"):
-                    clone_path = clone_path.with_suffix("." + extension)
-                    audio_files.append((f, clone_path))
+
+def iter_walk(src_dir, dest_dir, extension, base_dir=None, summaries=None,
+              sniff=False, threads=None, split_cue=False, recursive=True):
+    """
+    Recursively walks the source directory and returns a generator of
+    (src, clone_path, is_audio) tuples, produced as files are found, without keeping
+    the whole tree in memory. The directories are checked before returning.
+
+    Without recursive, only the files of src_dir itself are yielded.
+
+    With split_cue, an audio file holding several tracks of a cue sheet next to it is
+    yielded once per track, is_audio is then the cue.Segment of the track and clone_path
+    is named after the track.
+
+    The files of a directory are yielded before its subdirectories are visited. When
+    summaries is given, directories whose mtime matches the summary are not listed,
+    their files are skipped and only their recorded subdirectories are visited. Once
+    the files of a listed directory have been consumed, its summary is recorded.
+
+    Files are classified by extension. With sniff, files whose extension is missing or
+    unknown are opened and classified by their leading bytes. With threads, the
+    subdirectories of a directory are read ahead in a thread pool, the order of the
+    results does not change.
+    """
+    base_dir = base_dir or src_dir
+    _check_dirs(src_dir, dest_dir)
+    suffix = "." + extension
+
+    def unchanged(dir, mtime_ns):
+        if summaries is None:
+            return None
+        return summaries.unchanged_dir(str(dir.relative_to(base_dir)), mtime_ns)
+
+    def stat_children(dir, names):
+        children = []
+        for name in names:
+            try:
+                st = os.stat(str(dir / name))
+            except FileNotFoundError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                children.append((name, st.st_mtime_ns))
+        return children
+
+    def visit(pool, dir, mtime_ns, listing):
+        rel = dir.relative_to(base_dir)
+        clone_dir = dest_dir / rel
+        entries = listing.result() if listing is not None else _list_dir(str(dir))
+        segments = _cue_segments(entries) if split_cue else {}
+
+        subdirs = []
+        for entry in entries:
+
+            if entry.is_file():
+                f = dir / entry.name
+                audio = is_audio_name(entry.name)
+                if audio is None:
+                    audio = sniff and sniff_audio(entry.path)
+                clone_path = clone_dir / entry.name
+                if audio and segments.get(entry.name):
+                    for segment in segments[entry.name]:
+                        yield (f, clone_dir / (cue.track_name(segment) + suffix), segment)
+                elif audio:
+                    clone_path = clone_path.with_suffix(suffix)
+                    yield (f, clone_path, True)
                 else:
-                    other_files.append((f, clone_path))
-            if f.is_dir():
-                walker(f)
+                    yield (f, clone_path, False)
+            if entry.is_dir():
+                subdirs.append(entry)
 
-    walker(src_dir)
+        # The consumer has looked at every file of the directory by now.
+        if summaries is not None:
+            summaries.record_dir(str(rel), mtime_ns, [e.name for e in subdirs])
+
+        if not recursive:
+            return
+        children = [(e.name, e.stat().st_mtime_ns if summaries is not None else None)
+                    for e in subdirs]
+        yield from descend(pool, dir, children)
+
+    def descend(pool, dir, children):
+        # Directories whose summary matches are not listed, only their subdirectories are
+        # visited. The others are read ahead in the pool, if any.
+        todo = []
+        for name, mtime_ns in children:
+            sub = dir / name
+            names = unchanged(sub, mtime_ns)
+            if names is not None:
+                todo.append((sub, mtime_ns, names, None))
+            else:
+                listing = pool.submit(_list_dir, str(sub)) if pool is not None else None
+                todo.append((sub, mtime_ns, None, listing))
+
+        for sub, mtime_ns, names, listing in todo:
+            if names is not None:
+                yield from descend(pool, sub, stat_children(sub, names))
+            else:
+                yield from visit(pool, sub, mtime_ns, listing)
+
+    def root(pool):
+        mtime_ns = src_dir.stat().st_mtime_ns if summaries is not None else None
+        names = unchanged(src_dir, mtime_ns)
+        if names is not None:
+            yield from descend(pool, src_dir, stat_children(src_dir, names))
+        else:
+            yield from visit(pool, src_dir, mtime_ns, None)
+
+    def run():
+        if not threads or threads <= 1:
+            yield from root(None)
+            return
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            yield from root(pool)
+
+    return run()
+
+
+def walk(src_dir, dest_dir, extension, base_dir=None):
+    """
+    Recursively walks the source directory and categorizes files as audio or
+    other.
+
+    Returns a list of audio (src, clone_path) pairs and a list of other pairs.
+    """
+    audio_files = list()
+    other_files = list()
+    for src, clone_path, is_audio in iter_walk(src_dir, dest_dir, extension, base_dir):
+        if is_audio:
+            audio_files.append(_job(src, clone_path, is_audio))
+        else:
+            other_files.append((src, clone_path))
     return audio_files, other_files
 
 
+def _job(src, dest, is_audio):
+    # Jobs are (src, dest) pairs, with a third item for the segment of a cue track.
+    if is_audio is True:
+        return (src, dest)
+    return (src, dest, is_audio)
+
+
 def build_tree(pairs):
-    for _, clone_path in pairs:
-        clone_path.parent.mkdir(parents=True, exist_ok=True)
+    for pair in pairs:
+        pair[1].parent.mkdir(parents=True, exist_ok=True)
 
 
-def hardlink_tree(pairs, journal):
-    for src, copy in pairs:
-        if not copy.exists():
+# ioctl request cloning a whole file, from linux/fs.h.
+FICLONE = 0x40049409
+
+# Errors meaning a method is not supported here, the next one is tried.
+_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY,
+                errno.EPERM, errno.EBADF}
+
+
+def _reflink(src_fd, dest_fd, size):
+    import fcntl
+    fcntl.ioctl(dest_fd, FICLONE, src_fd)
+
+
+def _copy_file_range(src_fd, dest_fd, size):
+    offset = 0
+    while offset < size:
+        n = os.copy_file_range(src_fd, dest_fd, size - offset)
+        if n == 0:
+            break
+        offset += n
+
+
+def _sendfile(src_fd, dest_fd, size):
+    offset = 0
+    while offset < size:
+        n = os.sendfile(dest_fd, src_fd, offset, size - offset)
+        if n == 0:
+            break
+        offset += n
+
+
+def _copy_methods():
+    methods = []
+    if hasattr(os, "copy_file_range"):
+        methods.append(("copy_file_range", _copy_file_range))
+    if hasattr(os, "sendfile"):
+        methods.append(("sendfile", _sendfile))
+    return methods
+
+
+def clone_file(src, copy):
+    """
+    Clone src to copy with the cheapest method that works and return its name: a hard
+    link, a reflink on filesystems sharing extents such as btrfs and XFS, an in kernel
+    copy with copy_file_range or sendfile, and a copy through userspace as a last resort.
+    """
+    try:
+        os.link(str(src), str(copy))
+        return "hardlink"
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED:
+            raise
+    methods = [("reflink", _reflink)] + _copy_methods()
+    with open(str(src), "rb") as fsrc, open(str(copy), "wb") as fdest:
+        size = os.fstat(fsrc.fileno()).st_size
+        for name, method in methods:
             try:
-                os.link(str(src), str(copy))
+                method(fsrc.fileno(), fdest.fileno(), size)
+                break
             except OSError as e:
-                if e.errno == errno.EXDEV:
-                    shutil.copy(str(src), str(copy))
-                else:
+                if e.errno not in _UNSUPPORTED:
                     raise
-            journal.add(copy.absolute())
+                # Start over, a method may fail midway.
+                fsrc.seek(0)
+                fdest.seek(0)
+                fdest.truncate()
+        else:
+            name = "copy"
+            shutil.copyfileobj(fsrc, fdest, 1 << 20)
+    shutil.copymode(str(src), str(copy))
+    return name
+
+
+class Cloner:
+
+    """
+    Clones files in a thread pool, alongside the encoding. The journal is not thread safe,
+    clones are journaled by drain, from the thread that submitted them. The number of
+    files and bytes cloned with each method is logged by close.
+
+    A Cloner may be shared by several walks, e.g. the rescans of the watch mode, a copy
+    that is already pending is not submitted twice.
+    """
+
+    def __init__(self, threads=4):
+        self._pool = ThreadPoolExecutor(threads)
+        self._futures = deque()
+        self._pending = set()
+        self._stats = {}
+
+    def submit(self, src, copy, journal):
+        """
+        Clone src to copy, replacing copy if it exists, and journal it as CLONED.
+        """
+        key = os.path.abspath(str(copy))
+        if key in self._pending:
+            return
+        self._pending.add(key)
+        self._futures.append((self._pool.submit(self._clone, src, copy), src, copy, journal))
+
+    @staticmethod
+    def _clone(src, copy):
+        if copy.exists():
+            copy.unlink()
+        return clone_file(src, copy), os.stat(str(copy)).st_size
+
+    def drain(self, wait=False):
+        from .journal import CLONED  # journal imports this module
+        while self._futures and (wait or self._futures[0][0].done()):
+            future, src, copy, journal = self._futures.popleft()
+            self._pending.discard(os.path.abspath(str(copy)))
+            try:
+                method, size = future.result()
+            except OSError as e:
+                logging.error("could not clone {} to {}: {}", src, copy, e)
+                continue
+            stats = self._stats.setdefault(method, [0, 0])
+            stats[0] += 1
+            stats[1] += size
+            journal.add(copy.absolute(), src, CLONED)
+
+    @property
+    def stats(self):
+        """
+        Dict mapping each method used to the number of files and bytes cloned with it.
+        """
+        return {method: {"files": files, "bytes": size}
+                for method, (files, size) in self._stats.items()}
+
+    def close(self):
+        self.drain(wait=True)
+        self._pool.shutdown()
+        for method, (files, size) in sorted(self._stats.items()):
+            logging.info("cloned {} files, {:.1f} MB with {}", files, size / 1e6, method)
+
+
+def unshare(path):
+    """
+    Remove path if it is a hard link, so that writing to it does not write to the file it
+    is linked with, e.g. the source of a passthrough.
+    """
+    try:
+        if os.stat(str(path)).st_nlink > 1:
+            os.unlink(str(path))
+    except FileNotFoundError:
+        pass
+
+
+def move_file(src, dest):
+    """
+    Move src over dest. Across filesystems, src is copied to a temporary file next to
+    dest, synced and renamed over it, so that dest is either the old or the whole new
+    file, never a truncated one.
+    """
+    try:
+        os.replace(str(src), str(dest))
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    tmp = dest.with_name(".{}.pyaconv-tmp".format(dest.name))
+    try:
+        # copyfile uses sendfile where available, large sequential writes.
+        shutil.copyfile(str(src), str(tmp))
+        fd = os.open(str(tmp), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(str(tmp), str(dest))
+    except BaseException:
+        try:
+            os.unlink(str(tmp))
+        except FileNotFoundError:
+            pass
+        raise
+    os.unlink(str(src))
+
+
+def hardlink_tree(pairs, journal, threads=4):
+    cloner = Cloner(threads)
+    for src, copy in pairs:
+        if not copy.exists():
+            cloner.submit(src, copy, journal)
+    cloner.close()
+
+
+def stream_tree(entries, journal, threads=4, cloner=None):
+    """
+    Consumes the entries of iter_walk lazily. Journaled files are skipped, directories
+    are created and other files are cloned by a Cloner with that many threads as they go
+    by, or by cloner, which is then left open and drained by its owner. The audio
+    (src, clone_path) pairs that still need to be encoded are yielded.
+    """
+    shared = cloner is not None
+    cloner = cloner or Cloner(threads)
+    last_parent = None
+    for src, clone_path, is_audio in entries:
+        cloner.drain()
+        if journal.is_current(src, clone_path):
+            logging.info("skipping {} (already encoded)", src)
+            continue
+        # Files come grouped by directory, only mkdir when the directory changes.
+        if clone_path.parent != last_parent:
+            clone_path.parent.mkdir(parents=True, exist_ok=True)
+            last_parent = clone_path.parent
+        if is_audio:
+            yield _job(src, clone_path, is_audio)
+        else:
+            # The copy is replaced if the source changed since it was cloned.
+            cloner.submit(src, clone_path, journal)
+    _finish_cloner(cloner, shared)
+
+
+def _finish_cloner(cloner, shared):
+    # The walk may be pulled from the main loop, a shared cloner is not waited for.
+    if shared:
+        cloner.drain()
+    else:
+        cloner.close()
+
+
+def stream_targets(entries, dest_dir, targets, threads=4, cloner=None):
+    """
+    Like stream_tree, for several targets encoded in the same pass. The entries come from
+    iter_walk against dest_dir, targets is a list of (dest_dir, extension, journal). Other
+    files are cloned into every target. Audio files are yielded as (src, clone_paths)
+    pairs with a clone path per target, None for the targets that are current.
+    """
+    shared = cloner is not None
+    cloner = cloner or Cloner(threads)
+    last_parents = [None] * len(targets)
+    for src, clone_path, is_audio in entries:
+        cloner.drain()
+        rel = clone_path.relative_to(dest_dir)
+        clones = []
+        for i, (target_dir, extension, journal) in enumerate(targets):
+            target = target_dir / rel
+            if is_audio:
+                target = target.with_suffix("." + extension)
+            if journal.is_current(src, target):
+                clones.append(None)
+                continue
+            if target.parent != last_parents[i]:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                last_parents[i] = target.parent
+            if not is_audio:
+                cloner.submit(src, target, journal)
+            clones.append(target)
+        if not is_audio:
+            continue
+        if any(c is not None for c in clones):
+            yield _job(src, tuple(clones), is_audio)
+        else:
+            logging.info("skipping {} (already encoded)", src)
+    _finish_cloner(cloner, shared)
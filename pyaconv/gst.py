@@ -1,9 +1,33 @@
-from gi.repository import GObject, Gst
+from collections import deque
+from gi.repository import GLib, GObject, Gst
+import multiprocessing
 import os
+import queue as queue_mod
+import threading
+import time
 
 
-from .fsutil import Path
-from . import logging
+from . import fsutil, logging
+from .budget import BRANCH_MEMORY, PIPELINE_MEMORY
+from .journal import ENCODED, BaseJournal
+from .stage import Stager
+
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def init():
+    """
+    Initialize GStreamer, once. Loading the plugin registry is the bulk of the startup
+    time, it is only done before the first pipeline or probe, commands that build none
+    never pay for it.
+    """
+    global _initialized
+    with _init_lock:
+        if not _initialized:
+            GObject.threads_init()
+            Gst.init(None)
+            _initialized = True
 
 
 class BaseProperty:
@@ -12,7 +36,10 @@ class BaseProperty:
         self.name = name
         self.help = help
 
-    def add_argument(self, arg_parser):
+    def add_argument(self, arg_parser, prefix=""):
+        """
+        Add the option for this property, its name is preceded by prefix, if any.
+        """
         raise NotImplementedError
 
 
@@ -23,9 +50,9 @@ class Property(BaseProperty):
         self.type = type
         self.default = default
 
-    def add_argument(self, arg_parser):
+    def add_argument(self, arg_parser, prefix=""):
         if self.type is not bool:
-            arg_parser.add_argument("--" + self.name,
+            arg_parser.add_argument("--" + prefix + self.name,
                                     type=self.type,
                                     default=self.default,
                                     metavar="",
@@ -33,14 +60,14 @@ class Property(BaseProperty):
         else:
             true_def = " (default)" if self.default else ""
             false_def = " (default)" if not self.default else ""
-            arg_parser.add_argument("--" + self.name,
+            arg_parser.add_argument("--" + prefix + self.name,
                                     default=self.default,
-                                    dest=self.name,
+                                    dest=(prefix + self.name).replace("-", "_"),
                                     action="store_true",
                                     help=self.help + true_def)
-            arg_parser.add_argument("--no-" + self.name,
+            arg_parser.add_argument("--no-" + prefix + self.name,
                                     default=self.default,
-                                    dest=self.name,
+                                    dest=(prefix + self.name).replace("-", "_"),
                                     action="store_false",
                                     help="no " + self.help + false_def)
 
@@ -54,9 +81,9 @@ class PropertyEnum(BaseProperty):
         self.default = default
         self.type = type
 
-    def add_argument(self, arg_parser):
+    def add_argument(self, arg_parser, prefix=""):
         s = ', '.join(str(v) for v in self.values)
-        arg_parser.add_argument("--" + self.name,
+        arg_parser.add_argument("--" + prefix + self.name,
                                 choices=self.values,
                                 default=self.default,
                                 metavar="",
@@ -72,8 +99,8 @@ class PropertyRange(BaseProperty):
         self.max = max
         self.default = default
 
-    def add_argument(self, arg_parser):
-        arg_parser.add_argument("--" + self.name,
+    def add_argument(self, arg_parser, prefix=""):
+        arg_parser.add_argument("--" + prefix + self.name,
                                 type=int,
                                 choices=range(self.min, self.max + 1),
                                 default=self.default or None,
@@ -81,43 +108,207 @@ class PropertyRange(BaseProperty):
                                 metavar="[{}-{}]".format(self.min, self.max))
 
 
+_DECODE_PIPELINE = """filesrc name=src ! decodebin name=dec ! audioconvert name=conv"""
+
+# ReplayGain analysis of the decoded audio, fed from a tee. rganalysis only takes rates up
+# to 48 kHz, the encoding branches keep the rate of the source.
+_ANALYSIS_BRANCH = """queue ! audioconvert ! audioresample ! rganalysis name=rga ! \
+fakesink name=rgsink sync=false async=false"""
+
+
 class BaseEncoder:
 
-    def __init__(self, *, loop, src, dest, eos_cb=None, err_cb=None,
+    def __init__(self, *, loop, src=None, dest=None, eos_cb=None, err_cb=None,
                  props=None):
+        init()
         pipeline = self.__class__.pipeline(props)
         self._loop = loop
+        self._props = props
         self._pipeline = Gst.parse_launch(pipeline)
         self._src = self._pipeline.get_by_name("src")
+        self._dec = self._pipeline.get_by_name("dec")
+        self._conv = self._pipeline.get_by_name("conv")
         self._enc = self._pipeline.get_by_name("enc")
         self._dest = self._pipeline.get_by_name("dest")
         self._bus = self._pipeline.get_bus()
-        self._eos_cb = eos_cb
-        self._err_cb = err_cb
+        self._eos_cb = None
+        self._err_cb = None
+        self._active = False
+        self._segment = None
+        self._seek_pending = False
+        self._gain = None
 
+        # The delayed link created by parse_launch is only made once, relink the decoder
+        # ourselves so that the pipeline can be reused for the next file.
+        if self._dec is not None and self._conv is not None:
+            self._dec.connect("pad-added", self._pad_added)
         self._bus.add_watch(0, self._bus_callback, None)
 
+        self.apply_props(props, self._enc)
+
+        if src is not None:
+            self.prepare(src, dest, eos_cb=eos_cb, err_cb=err_cb)
+
+    @property
+    def key(self):
+        return pool_key(self.__class__, self._props)
+
+    def prepare(self, src, dest, *, eos_cb=None, err_cb=None, segment=None):
+        """
+        Point the pipeline at a new source and destination. The pipeline must be stopped.
+        With a cue.Segment, only that time range of the source is encoded.
+        """
         self._src.set_property("location", src)
         self._dest.set_property("location", dest)
-
-        self.apply_props(props, self._enc)
+        self._eos_cb = eos_cb
+        self._err_cb = err_cb
+        self._segment = segment
 
     def start(self):
         """
         Start the Gstreamer pipeline, starting the encoding process.
         """
+        self._active = True
+        if self._segment is not None:
+            # Seeking needs a prerolled pipeline, see _start_segment.
+            self._seek_pending = True
+            self._pipeline.set_state(Gst.State.PAUSED)
+        else:
+            self._pipeline.set_state(Gst.State.PLAYING)
+
+    def _start_segment(self):
+        self._seek_pending = False
+        seg = self._segment
+        stop_type = Gst.SeekType.NONE if seg.end is None else Gst.SeekType.SET
+        stop = -1 if seg.end is None else int(seg.end * Gst.SECOND)
+        self._pipeline.seek(1.0, Gst.Format.TIME,
+                            Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE,
+                            Gst.SeekType.SET, int(seg.start * Gst.SECOND), stop_type, stop)
+        tags = _segment_tags(seg)
+        for elem in self._pipeline.iterate_all_by_interface(Gst.TagSetter):
+            elem.merge_tags(tags, Gst.TagMergeMode.REPLACE)
         self._pipeline.set_state(Gst.State.PLAYING)
 
+    def _query_seconds(self, query):
+        ok, value = query(Gst.Format.TIME)
+        if not ok or value < 0:
+            return None
+        return value / Gst.SECOND
+
+    def position(self):
+        """
+        Return how far into the source the pipeline is, in seconds, or None if unknown.
+        """
+        position = self._query_seconds(self._pipeline.query_position)
+        if position is not None and self._segment is not None:
+            position = max(0.0, position - self._segment.start)
+        return position
+
+    def duration(self):
+        """
+        Return the duration of the source in seconds, or None if unknown.
+        """
+        if self._segment is not None and self._segment.end is not None:
+            return self._segment.length
+        duration = self._query_seconds(self._pipeline.query_duration)
+        if duration is not None and self._segment is not None:
+            duration -= self._segment.start
+        return duration
+
+    def reset(self):
+        """
+        Stop the pipeline so that it can be prepared for another file. Going to NULL also
+        flushes the bus, stale messages from the previous file are never delivered.
+        """
+        self._active = False
+        self._eos_cb = None
+        self._err_cb = None
+        self._pipeline.set_state(Gst.State.NULL)
+        if self._segment is not None:
+            for elem in self._pipeline.iterate_all_by_interface(Gst.TagSetter):
+                elem.reset_tags()
+            self._segment = None
+        self._seek_pending = False
+        self._gain = None
+
+    def gain(self):
+        """
+        Return the (track gain in dB, track peak) found by the ReplayGain analysis, once
+        the end of the stream is reached, None without analysis.
+        """
+        return self._gain
+
+    def close(self):
+        """
+        Tear down the pipeline and its bus watch. The encoder cannot be used afterwards.
+        """
+        self.reset()
+        self._bus.remove_watch()
+
     def __del__(self):
         self._pipeline.set_state(Gst.State.NULL)
 
+    def _dest_location(self):
+        return self._dest.get_property("location")
+
+    def _sinks(self):
+        return [self._dest]
+
+    def add_io_probes(self, read_cb=None, write_cb=None):
+        """
+        Call read_cb with the size of each buffer read from the source and write_cb with
+        the size of each buffer written to a destination, from the streaming threads.
+        Either may block to slow the pipeline down.
+        """
+        def probe(cb):
+            def on_buffer(pad, info):
+                cb(info.get_buffer().get_size())
+                return Gst.PadProbeReturn.OK
+            return on_buffer
+
+        if read_cb is not None:
+            self._src.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER,
+                                                      probe(read_cb))
+        if write_cb is not None:
+            for sink in self._sinks():
+                sink.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER,
+                                                      probe(write_cb))
+
+    def watch_elements(self, cb):
+        """
+        Call cb with every element of the pipeline, and with the elements added later on
+        inside its bins, e.g. by decodebin for each file.
+        """
+        for elem in self._pipeline.iterate_recurse():
+            cb(elem)
+        self._pipeline.connect("deep-element-added", lambda bin, sub, elem: cb(elem))
+
+    def _pad_added(self, dec, pad):
+        sink = self._conv.get_static_pad("sink")
+        if not sink.is_linked():
+            pad.link(sink)
+
     def _bus_callback(self, bus, message, _):
         # print(Gst.message_type_get_name(message.type))
-        if message.type == Gst.MessageType.EOS:
+        if not self._active:
+            return True
+        if message.type == Gst.MessageType.ASYNC_DONE:
+            if self._seek_pending:
+                self._start_segment()
+        elif message.type == Gst.MessageType.TAG:
+            # The other sinks also report the tags of the source, which may hold a gain.
+            if message.src.get_name() == "rgsink":
+                tags = message.parse_tag()
+                ok_gain, gain = tags.get_double(Gst.TAG_TRACK_GAIN)
+                ok_peak, peak = tags.get_double(Gst.TAG_TRACK_PEAK)
+                if ok_gain and ok_peak:
+                    self._gain = (gain, peak)
+        elif message.type == Gst.MessageType.EOS:
+            self._active = False
             if self._eos_cb is not None:
-                self._eos_cb(self._src.get_property("location"),
-                             self._dest.get_property("location"))
+                self._eos_cb(self._src.get_property("location"), self._dest_location())
         elif message.type == Gst.MessageType.ERROR:
+            self._active = False
             err, _ = message.parse_error()
             src_elem = None
             if isinstance(message.src, Gst.Element):
@@ -125,9 +316,7 @@ class BaseEncoder:
                 src_elem = fact.get_name()
             if self._err_cb is not None:
                 self._err_cb(err.message, src_elem)
-        else:
-            return True
-        return False
+        return True
 
     def apply_props(self, props, enc):
         """
@@ -142,80 +331,781 @@ class BaseEncoder:
         """
         raise NotImplementedError
 
+    @classmethod
+    def branch(cls, props, n=""):
+        """
+        Return the encoding part of the pipeline, it receives raw audio at the sample rate
+        of the source. The encoder should be named enc and the filesink dest, both followed
+        by n, which tells branches apart when several share a pipeline.
+        """
+        raise NotImplementedError
+
     @classmethod
     def pipeline(cls, props):
         """
         Return the pipeline string used to initialize this encoder class. There should be a
         filesrc named src and a filesink named dest. The encoder should be named enc. The
-        BaseEncoder will automatically get those objects from the pipeline.
+        BaseEncoder will automatically get those objects from the pipeline. The decodebin
+        should be named dec and the element it links to conv, so that the pipeline can be
+        relinked when it is reused. By default, the branch is appended to a decoder. With
+        the "replaygain" property, the decoded audio is also analysed, see gain.
         """
-        raise NotImplementedError
+        if props.get("replaygain"):
+            return " ".join([_DECODE_PIPELINE + " ! tee name=t", "t. ! " + _ANALYSIS_BRANCH,
+                             "t. ! queue ! audioresample ! " + cls.branch(props)])
+        return _DECODE_PIPELINE + " ! audioresample ! " + cls.branch(props)
+
+    @classmethod
+    def job_props(cls, props, dest):
+        """
+        Return the properties to encode a job with, they may depend on its destination.
+        """
+        return props
+
+    @classmethod
+    def passthrough_extensions(cls):
+        """
+        Return the source extensions worth probing for a passthrough, e.g. (".mp3",).
+        """
+        return ()
+
+    @classmethod
+    def can_passthrough(cls, props, info):
+        """
+        Return whether a source described by info, see cost.Prober.stream_info, already
+        satisfies the properties and can be copied instead of encoded.
+        """
+        return False
+
+    @classmethod
+    def bitrate(cls, props):
+        """
+        Return the approximate average bitrate of the output in bits per second, for
+        size estimates, None when it cannot be told from the properties.
+        """
+        return None
+
+    @classmethod
+    def memory(cls, props):
+        """
+        Return the estimated memory of a pipeline in bytes, for memory budgets.
+        """
+        branches = 2 if props.get("replaygain") else 1
+        return PIPELINE_MEMORY + branches * BRANCH_MEMORY
+
+
+def _segment_tags(segment):
+    tags = Gst.TagList.new_empty()
+    names = (("title", Gst.TAG_TITLE), ("performer", Gst.TAG_ARTIST), ("album", Gst.TAG_ALBUM))
+    for key, tag in names:
+        if segment.tags.get(key):
+            tags.add_value(Gst.TagMergeMode.REPLACE, tag, segment.tags[key])
+    if "number" in segment.tags:
+        number = GObject.Value(GObject.TYPE_UINT, segment.tags["number"])
+        tags.add_value(Gst.TagMergeMode.REPLACE, Gst.TAG_TRACK_NUMBER, number)
+    return tags
+
+
+def freeze_props(props):
+    return tuple(sorted(props.items()))
+
+
+class MultiEncoder(BaseEncoder):
+
+    """
+    Decodes a source once and encodes it with several encoders, the decoded audio is split
+    with a tee and each branch has its own queue, resampler and encoder. The props hold a
+    "targets" tuple of (encoder class, frozen props) pairs, see targets_props. The
+    destination is a sequence with a location per target, None to skip a target.
+    """
+
+    def __init__(self, *, loop, props, **kwargs):
+        self._targets = [(cls, dict(frozen)) for cls, frozen in props["targets"]]
+        super().__init__(loop=loop, props=props, **kwargs)
+        self._dests = [self._pipeline.get_by_name("dest{}".format(i))
+                       for i in range(len(self._targets))]
+
+    @staticmethod
+    def targets_props(targets, replaygain=False):
+        props = {"targets": tuple((cls, freeze_props(props)) for cls, props in targets)}
+        if replaygain:
+            props["replaygain"] = True
+        return props
+
+    def apply_props(self, props, enc):
+        for i, (cls, target_props) in enumerate(self._targets):
+            cls.apply_props(self, target_props, self._pipeline.get_by_name("enc{}".format(i)))
+
+    def prepare(self, src, dest, *, eos_cb=None, err_cb=None, segment=None):
+        self._src.set_property("location", src)
+        locations = [d for d in dest if d is not None]
+        for sink, location in zip(self._dests, locations):
+            sink.set_property("location", location)
+        self._eos_cb = eos_cb
+        self._err_cb = err_cb
+        self._segment = segment
+
+    def _dest_location(self):
+        return tuple(sink.get_property("location") for sink in self._dests)
+
+    def _sinks(self):
+        return self._dests
+
+    @classmethod
+    def pipeline(cls, props):
+        branches = ["t. ! queue ! audioconvert ! audioresample ! " + enc.branch(dict(p), i)
+                    for i, (enc, p) in enumerate(props["targets"])]
+        if props.get("replaygain"):
+            branches.append("t. ! " + _ANALYSIS_BRANCH)
+        return " ".join([_DECODE_PIPELINE + " ! tee name=t"] + branches)
+
+    @classmethod
+    def memory(cls, props):
+        branches = len(props["targets"]) + (1 if props.get("replaygain") else 0)
+        return PIPELINE_MEMORY + branches * BRANCH_MEMORY
+
+    @classmethod
+    def job_props(cls, props, dest):
+        # Only build branches for the targets that need encoding.
+        return dict(props, targets=tuple(t for t, d in zip(props["targets"], dest)
+                                         if d is not None))
+
+
+def pool_key(encoder, props):
+    return (encoder, freeze_props(props or {}))
+
+
+class EncoderPool:
+
+    """
+    Keeps stopped encoders around so that their pipelines can be reused for the next file
+    instead of being parsed and instantiated again. Encoders are keyed by their class and
+    properties. When max_pipelines is set, no more than that many pipelines are kept alive,
+    idle pipelines are evicted to make room and extra pipelines are torn down on release.
+    A max_pipelines of 0 disables reuse entirely.
+
+    With a budget.Budget, the reads and writes of the pipelines are throttled. With a
+    profiling.Profiler, the pipelines are profiled.
+    """
+
+    def __init__(self, loop, max_pipelines=None, budget=None, profiler=None):
+        self._loop = loop
+        self._max = max_pipelines
+        self._budget = budget
+        self._profiler = profiler
+        self._idle = {}
+        self._live = 0
+
+    def acquire(self, encoder, props):
+        idle = self._idle.get(pool_key(encoder, props))
+        if idle:
+            return idle.pop()
+        if self._max is not None and self._live >= self._max:
+            self._evict()
+        self._live += 1
+        enc = encoder(loop=self._loop, props=props)
+        if self._budget is not None:
+            self._budget.attach(enc)
+        if self._profiler is not None:
+            self._profiler.attach(enc)
+        return enc
+
+    def release(self, enc):
+        if self._max is not None and self._live > self._max:
+            self.discard(enc)
+            return
+        enc.reset()
+        self._idle.setdefault(enc.key, []).append(enc)
+
+    def discard(self, enc):
+        self._live -= 1
+        enc.close()
+
+    def _evict(self):
+        for idle in self._idle.values():
+            if idle:
+                self.discard(idle.pop())
+                return
+
+    def close(self):
+        for idle in self._idle.values():
+            for enc in idle:
+                self.discard(enc)
+        self._idle.clear()
+
+    def __len__(self):
+        return self._live
 
 
 class Worker:
 
-    def __init__(self, loop, queue, journal, finished_cb, encoder, props):
+    def __init__(self, loop, jobs, journal, finished_cb, encoder, props, pool, progress=None,
+                 index=0, stop_on_error=True, stager=None, failed_cb=None, replaygain=None):
         self._loop = loop
-        self._queue = queue
+        self._replaygain = replaygain
+        self._failed_cb = failed_cb
+        self._stager = stager
+        self._staged = None
+        self._stop_on_error = stop_on_error
+        self._progress = progress
+        self._index = index
+        self._jobs = jobs
         self._journal = journal
         self._finished = False
         self._finished_cb = finished_cb
         self._encoder = encoder
         self._props = props
+        self._pool = pool
+        self._enc = None
+        self._job = None
+        self._parked = False
+        self._idle = False
+        # Audio seconds of the files encoded so far.
+        self._encoded = 0.0
 
     def _eos_cb(self, src, dest):
-        dest = Path(dest)
-        self._journal.add(dest)
+        src, dest = self._job[0], self._job[1]
+        self._encoded += self._enc.duration() or 0.0
+        if self._replaygain is not None:
+            # Tag the file before it is moved, while it is still local when staged.
+            written = self._staged if self._stager is not None else dest
+            self._replaygain.track(dest, written, self._enc.gain(), self._enc.duration())
+        if self._stager is not None:
+            self._stager.move(self._staged, dest, src)
+        else:
+            self._journal.add(dest, src)
+        if self._progress is not None:
+            # The pipeline is still at EOS, its duration can be queried.
+            self._progress.finish(self._index)
+        self._pool.release(self._enc)
+        self._enc = None
         self._next()
 
     def _next(self):
-        if len(self._queue) > 0:
-            src, dest = self._queue.popleft()
+        if self._parked:
+            self._idle = True
+            self._finished_cb()
+            return
+        # Pulling the next job may walk the source tree until an audio file is found.
+        job = next(self._jobs, None)
+        if job is not None:
+            self._job = job
+            # Jobs of cue tracks carry their segment as a third item.
+            src, dest = job[0], job[1]
+            segment = job[2] if len(job) > 2 else None
             logging.info("encoding {} -> {}", src, dest)
-            enc = self._encoder(loop=self._loop, src=src, dest=dest,
-                                eos_cb=self._eos_cb,
-                                err_cb=self._error,
-                                props=self._props)
-            enc.start()
+            for d in dest if isinstance(dest, tuple) else (dest,):
+                if d is not None:
+                    fsutil.unshare(d)
+            props = self._encoder.job_props(self._props, dest)
+            self._enc = self._pool.acquire(self._encoder, props)
+            if self._stager is not None:
+                self._staged = self._stager.stage(dest)
+                dest = self._staged
+            self._enc.prepare(src, dest, eos_cb=self._eos_cb, err_cb=self._error,
+                              segment=segment)
+            if self._progress is not None:
+                self._progress.start(self._index, src, self._enc)
+            self._enc.start()
         else:
+            if self._progress is not None:
+                self._progress.exhausted()
             self._finished = True
             self._finished_cb()
 
     def start(self):
+        self._finished = False
+        self._idle = False
         self._next()
 
+    def park(self):
+        """
+        Stop taking jobs once the current one is done.
+        """
+        self._parked = True
+
+    def unpark(self):
+        self._parked = False
+        if self._idle:
+            self.start()
+
+    @property
+    def parked(self):
+        return self._parked
+
     @property
     def finished(self):
         return self._finished
 
+    @property
+    def idle(self):
+        """
+        Whether the worker does not encode anything, because it is parked or finished.
+        """
+        return self._finished or self._idle
+
+    def abort(self):
+        """
+        Stop the file in progress without journaling it and take no more jobs. The
+        destination is left as it is.
+        """
+        self._parked = True
+        self._finished = True
+        if self._enc is not None:
+            self._pool.discard(self._enc)
+            self._enc = None
+            if self._stager is not None:
+                self._stager.discard(self._staged)
+
+    def encoded(self):
+        """
+        Return the audio seconds encoded so far, including the file in progress.
+        """
+        position = self._enc.position() if self._enc is not None else None
+        return self._encoded + (position or 0.0)
+
     def _error(self, error_msg, src_elem):
         if src_elem is not None:
             logging.error("gstreamer error in element '{}': {}\n", src_elem,
                           error_msg)
         else:
             logging.error("gstreamer error: %s", error_msg)
-        self._loop.quit()
+        # A pipeline that errored out is not trusted for reuse.
+        self._pool.discard(self._enc)
+        self._enc = None
+        if self._stager is not None:
+            self._stager.discard(self._staged)
+        if self._stop_on_error:
+            self._loop.quit()
+        else:
+            if self._progress is not None:
+                self._progress.finish(self._index)
+            if self._failed_cb is not None:
+                self._failed_cb(self._job, error_msg)
+            self._next()
+
+
+def _dest_keys(dest):
+    dests = dest if isinstance(dest, tuple) else (dest,)
+    return {os.path.abspath(str(d)) for d in dests if d is not None}
+
+
+class JobQueue:
+
+    """
+    Chains iterables of jobs, more can be added while the jobs are being pulled.
+
+    A job whose destination is taken by a job in flight is held back, e.g. a file found
+    again by a rescan while it is encoded, or two sources with the same destination.
+    Destinations are given back with release once their job is journaled or failed, the
+    jobs held back on them are handed out first after that.
+    """
+
+    def __init__(self, queue=()):
+        self._sources = deque([iter(queue)])
+        self._taken = set()
+        self._held = []
+
+    def extend(self, jobs):
+        self._sources.append(iter(jobs))
+
+    def release(self, dest):
+        """
+        Give the destinations of dest back, return whether a held job may now be taken.
+        """
+        self._taken.difference_update(_dest_keys(dest))
+        return any(self._taken.isdisjoint(_dest_keys(job[1])) for job in self._held)
+
+    @property
+    def held(self):
+        return len(self._held)
+
+    def _take(self, job):
+        self._taken.update(_dest_keys(job[1]))
+        return job
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        for i, job in enumerate(self._held):
+            if self._taken.isdisjoint(_dest_keys(job[1])):
+                del self._held[i]
+                return self._take(job)
+        while self._sources:
+            try:
+                job = next(self._sources[0])
+            except StopIteration:
+                self._sources.popleft()
+                continue
+            if not self._taken.isdisjoint(_dest_keys(job[1])):
+                logging.info("holding {} until its destination is done", job[0])
+                self._held.append(job)
+                continue
+            return self._take(job)
+        raise StopIteration
+
+
+class _ReleasingJournal(BaseJournal):
+
+    """
+    Gives the destinations of the completed files back to the scheduler, with release.
+    """
+
+    def __init__(self, journal, release):
+        self._journal = journal
+        self._release = release
+
+    def add(self, path, src=None, kind=ENCODED, alias=None):
+        self._journal.add(path, src, kind, alias)
+        self._release(path)
+
+    def __contains__(self, path):
+        return path in self._journal
+
+    def __len__(self):
+        return len(self._journal)
 
 
 class Scheduler:
 
-    def __init__(self, queue, journal, *, encoder, props, threads=None):
+    """
+    Runs the workers in a GLib main loop. The queue can be any iterable of (src, dest)
+    pairs, including a generator that is still walking the source tree, workers pull
+    from it as they become idle.
+
+    With keep_alive, the loop keeps running once the queue is empty, more jobs can be
+    given to submit, e.g. from a GLib callback, until quit is called.
+
+    With stage_dir, files are encoded into that directory and moved to their destination
+    by stage_threads mover threads, see stage.Stager.
+
+    Without keep_alive, an encoding error stops the loop, unless stop_on_error is False.
+    Otherwise the error is logged, given to failed_cb with the job if set, and the workers
+    carry on. Staged files that could not be moved to their destination are given to
+    failed_cb too.
+
+    With a replaygain.ReplayGain, the pipelines analyse the audio they encode and the
+    track gain of each file is given to it, props should then have "replaygain" set.
+
+    With an autoscale.Autoscaler, threads workers are active at first and the count is
+    adjusted every autoscale_interval seconds within the bounds of the autoscaler.
+
+    With a budget.Budget, the number of workers, and so of pipelines in flight, is capped
+    by its memory and their reads and writes are throttled to its rates.
+
+    With a profiling.Profiler, the time spent in each element of the pipelines is
+    measured, see Profiler.report.
+
+    With a fsutil.Cloner shared by the walks of the queue, the clones are journaled as
+    they complete and stop waits for the remaining ones.
+    """
+
+    def __init__(self, queue, journal, *, encoder, props, threads=None, max_pipelines=None,
+                 progress=None, report_interval=10, keep_alive=False, stage_dir=None,
+                 stage_threads=2, autoscaler=None, autoscale_interval=5, failed_cb=None,
+                 replaygain=None, budget=None, profiler=None, stop_on_error=None,
+                 cloner=None):
         if threads is None:
             threads = max(1, os.cpu_count() - 1)
+        if budget is not None:
+            threads = budget.pipelines(encoder, props, threads)
+            if autoscaler is not None:
+                autoscaler.maximum = budget.pipelines(encoder, props, autoscaler.maximum)
+                autoscaler.minimum = min(autoscaler.minimum, autoscaler.maximum)
+        active = threads
+        if autoscaler is not None:
+            threads = autoscaler.maximum
+        if max_pipelines is None:
+            max_pipelines = threads
         self._loop = GObject.MainLoop()
-        self._workers = [Worker(self._loop, queue, journal,
-                                self._worker_finished, encoder, props)
-                         for _ in range(threads)]
+        self._pool = EncoderPool(self._loop, max_pipelines, budget, profiler)
+        self._jobs = JobQueue(queue)
+        journal = _ReleasingJournal(journal, self._release)
+        self._failed_cb = failed_cb
+        if stop_on_error is None:
+            stop_on_error = not keep_alive
+        self._keep_alive = keep_alive
+        self._stager = None
+        if stage_dir is not None:
+            self._stager = Stager(stage_dir, journal, stage_threads, failed_cb=self._failed)
+        self._workers = [Worker(self._loop, self._jobs, journal,
+                                self._worker_finished, encoder, props, self._pool, progress,
+                                index=i, stop_on_error=stop_on_error, stager=self._stager,
+                                failed_cb=self._failed, replaygain=replaygain)
+                         for i in range(threads)]
+        for w in self._workers[active:]:
+            w.park()
+        self._autoscaler = autoscaler
+        self._autoscale_interval = autoscale_interval
+        self._cloner = cloner
         self._has_quit = False
+        self._timers = []
+        self._progress = progress
+        self._report_interval = report_interval
+
+    def _report(self):
+        self._progress.report()
+        return True
+
+    def _drain_cloner(self):
+        self._cloner.drain()
+        return True
+
+    def _release(self, dest):
+        # The jobs held back on dest are taken by the idle workers.
+        if self._jobs.release(dest):
+            self._wake()
+
+    def _failed(self, job, error):
+        self._release(job[1])
+        if self._failed_cb is not None:
+            self._failed_cb(job, error)
 
     def _worker_finished(self):
-        if all(w.finished for w in self._workers):
+        # Held jobs wait for the destinations in flight, e.g. staged files being moved.
+        if (not self._keep_alive and all(w.idle for w in self._workers) and
+                not self._jobs.held and not self._has_quit):
             self._has_quit = True
             self._loop.quit()
 
-    def run(self):
+    def _autoscale(self):
+        active = [w for w in self._workers if not w.parked]
+        if all(w.finished for w in active):
+            return True
+        encoded = sum(w.encoded() for w in self._workers)
+        target = self._autoscaler.decide(len(active), encoded)
+        if target < len(active):
+            for w in active[target:]:
+                w.park()
+        elif target > len(active):
+            for w in [w for w in self._workers if w.parked][:target - len(active)]:
+                w.unpark()
+        return True
+
+    def submit(self, jobs):
+        """
+        Add jobs to the queue and wake up the idle workers.
+        """
+        self._jobs.extend(jobs)
+        self._wake()
+
+    def _wake(self):
+        for w in self._workers:
+            if w.finished and not w.parked:
+                w.start()
+
+    @property
+    def loop(self):
+        return self._loop
+
+    def quit(self):
+        self._has_quit = True
+        self._loop.quit()
+
+    def abort(self):
+        """
+        Stop the pipelines in flight and drop the pending moves, then quit. The files in
+        progress are not journaled, their destinations are left as they are.
+        """
+        for w in self._workers:
+            w.abort()
+        if self._stager is not None:
+            self._stager.abort()
+        self.quit()
+
+    def start(self):
+        """
+        Start the workers and timers without running the loop, for callers iterating its
+        context themselves. stop must be called once done.
+        """
+        self._timers = []
+        if self._progress is not None:
+            self._timers.append(GLib.timeout_add_seconds(self._report_interval,
+                                                         self._report))
+        if self._stager is not None:
+            self._timers.append(GLib.timeout_add(500, self._stager.drain))
+        if self._cloner is not None:
+            self._timers.append(GLib.timeout_add(500, self._drain_cloner))
+        if self._autoscaler is not None:
+            self._timers.append(GLib.timeout_add_seconds(self._autoscale_interval,
+                                                         self._autoscale))
         for w in self._workers:
             w.start()
-        # check for early exits when the queue is empty
-        if not self._has_quit:
-            self._loop.run()
+
+    def stop(self):
+        self._pool.close()
+        for timer in self._timers:
+            GLib.source_remove(timer)
+        self._timers = []
+        if self._stager is not None:
+            self._stager.close()
+        if self._cloner is not None:
+            self._cloner.drain(wait=True)
+        if self._progress is not None:
+            self._progress.report()
+
+    def run(self):
+        try:
+            self.start()
+            # check for early exits when the queue is empty
+            if not self._has_quit:
+                self._loop.run()
+        finally:
+            self.stop()
+
+
+class _QueueJournal(BaseJournal):
+
+    """
+    Journal used in the child processes, completed files are sent back to the parent.
+    """
+
+    def __init__(self, results):
+        self._results = results
+
+    def add(self, path, src=None, kind=ENCODED, alias=None):
+        # Paths are pickled as is, they may be sequences of paths for a MultiEncoder.
+        self._results.put((path, src, kind, alias))
+
+    def failed(self, job, error):
+        # A kind of None reports a failure, with the error in place of the alias.
+        self._results.put((job[1], job[0], None, str(error)))
+
+    def __contains__(self, item):
+        return False
+
+    def __len__(self):
+        return 0
+
+
+def _queue_jobs(jobs):
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        yield job
+
+
+def _process_main(jobs, results, encoder, props, threads, max_pipelines, stage_dir,
+                  stage_threads, budget):
+    journal = _QueueJournal(results)
+    # A failed job is reported and the child carries on, quitting would drop the jobs its
+    # other workers have taken.
+    s = Scheduler(_queue_jobs(jobs), journal, encoder=encoder, props=props,
+                  threads=threads, max_pipelines=max_pipelines, stage_dir=stage_dir,
+                  stage_threads=stage_threads, budget=budget, stop_on_error=False,
+                  failed_cb=journal.failed)
+    s.run()
+
+
+class ProcessScheduler:
+
+    """
+    Runs a Scheduler with its own main loop and pipelines in each of several child
+    processes. The parent feeds jobs from the queue to the children through a bounded
+    queue and is the only one to write to the journal.
+
+    A budget.Budget is split evenly among the processes.
+
+    Jobs that fail to encode, and the jobs of a child that died before finishing them,
+    are logged and counted in failed once run returns.
+    """
+
+    def __init__(self, queue, journal, *, encoder, props, processes, threads=None,
+                 max_pipelines=None, progress=None, report_interval=10, stage_dir=None,
+                 stage_threads=2, budget=None):
+        if threads is None:
+            threads = max(1, (os.cpu_count() - 1) // processes)
+        self._budget = budget.split(processes) if budget is not None else None
+        self._stage_dir = stage_dir
+        self._stage_threads = stage_threads
+        self._jobs = iter(queue)
+        self._journal = journal
+        self._encoder = encoder
+        self._props = props
+        self._processes = processes
+        self._threads = threads
+        self._max_pipelines = max_pipelines
+        # Only completions are seen by the parent, there are no per worker metrics.
+        self._progress = progress
+        self._report_interval = report_interval
+        # (src, dests) -> job, for the jobs sent to the children and not reported yet.
+        self._outstanding = {}
+        self.failed = 0
+
+    @staticmethod
+    def _key(src, dest):
+        return str(src), frozenset(_dest_keys(dest))
+
+    def run(self):
+        # Children initialize their own GStreamer, forking an initialized one is unsafe.
+        ctx = multiprocessing.get_context("spawn")
+        jobs = ctx.Queue(maxsize=2 * self._processes * self._threads)
+        results = ctx.Queue()
+        procs = [ctx.Process(target=_process_main,
+                             args=(jobs, results, self._encoder, self._props,
+                                   self._threads, self._max_pipelines, self._stage_dir,
+                                   self._stage_threads, self._budget))
+                 for _ in range(self._processes)]
+        for proc in procs:
+            proc.start()
+
+        pending = None
+        exhausted = False
+        sentinels = self._processes
+        last_report = time.monotonic()
+        try:
+            while any(proc.is_alive() for proc in procs):
+                # Feed the children without blocking, the results must keep flowing.
+                while not exhausted or sentinels > 0:
+                    if pending is None:
+                        pending = next(self._jobs, None) if not exhausted else None
+                        if pending is None and not exhausted and self._progress is not None:
+                            self._progress.exhausted()
+                        exhausted = pending is None
+                    try:
+                        jobs.put(pending, block=False)
+                    except queue_mod.Full:
+                        break
+                    if pending is None:
+                        sentinels -= 1
+                    else:
+                        self._outstanding[self._key(pending[0], pending[1])] = pending
+                        if self._progress is not None:
+                            self._progress.start(pending[:2], pending[0])
+                    pending = None
+                self._drain(results, timeout=0.05)
+                if (self._progress is not None and
+                        time.monotonic() - last_report >= self._report_interval):
+                    self._progress.report()
+                    last_report = time.monotonic()
+            self._drain(results)
+            for job in self._outstanding.values():
+                logging.error("{} was not encoded, its process exited", job[0])
+                self.failed += 1
+            self._outstanding.clear()
+            if self._progress is not None:
+                self._progress.report()
+        finally:
+            # Jobs left over by children that died must not hold up the exit.
+            jobs.cancel_join_thread()
+            for proc in procs:
+                proc.join()
+
+    def _drain(self, results, timeout=None):
+        while True:
+            try:
+                dest, src, kind, alias = (results.get(timeout=timeout) if timeout
+                                          else results.get_nowait())
+            except queue_mod.Empty:
+                return
+            self._outstanding.pop(self._key(src, dest), None)
+            if kind is None:
+                logging.error("could not encode {}: {}", src, alias)
+                self.failed += 1
+            else:
+                self._journal.add(dest, src, kind, alias)
+            if self._progress is not None:
+                self._progress.finish((src, dest))
+            timeout = None
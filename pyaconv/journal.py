@@ -1,4 +1,8 @@
+import hashlib
 import json
+import os
+import sqlite3
+import time
 
 from .fsutil import Path
 from . import logging
@@ -13,11 +17,109 @@ def compare_props(left, right):
     return True
 
 
+def _dump_props(props):
+    # Canonical form, so that equal props always map to the same row.
+    return json.dumps(props, sort_keys=True)
+
+
+# Kinds of journal entries.
+ENCODED = "encoded"
+CLONED = "cloned"
+PASSTHROUGH = "passthrough"
+# A copy of the output of another entry whose source has the same content.
+ALIAS = "alias"
+
+# Reasons for a file not to be current, see BaseJournal.check.
+NEW = "new"
+PROPS_CHANGED = "props changed"
+SOURCE_CHANGED = "source changed"
+
+# Fingerprint of a source that could not be read once encoded, no file has a negative
+# size, the entry is found to be out of date by the next check.
+_UNKNOWN_SOURCE = (-1, None, None, None)
+
+
+def hash_file(path, chunk_size=1 << 20):
+    h = hashlib.blake2b(digest_size=16)
+    with open(str(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
 class BaseJournal:
 
-    def add(self, path):
+    def add(self, path, src=None, kind=ENCODED, alias=None):
         raise NotImplementedError
 
+    def is_current(self, src, dest):
+        """
+        Return whether dest was journaled from the current version of src.
+        """
+        return self.check(src, dest) is None
+
+    def check(self, src, dest):
+        """
+        Return why dest must be encoded again from src, NEW, PROPS_CHANGED or
+        SOURCE_CHANGED, None if it is current.
+        """
+        return None if dest.absolute() in self else NEW
+
+    def cached_duration(self, src, st):
+        """
+        Return the probed duration of src in seconds, if it was cached for this stat.
+        """
+        return None
+
+    def cache_duration(self, src, st, duration):
+        pass
+
+    def source_hash(self, src):
+        """
+        Return the content hash of src, cached when the journal can.
+        """
+        return hash_file(src)
+
+    def find_output(self, digest):
+        """
+        Return the path of an existing output, made with the current properties, of a
+        source with that content hash, None if there is none.
+        """
+        return None
+
+    def record_gain(self, path, gain, peak, duration):
+        """
+        Record the ReplayGain track gain and peak of an output, for album gains.
+        """
+        pass
+
+    def dir_gains(self, dir):
+        """
+        Return the (path, gain, peak, duration) recorded for the current outputs in a
+        destination directory, None if the journal does not keep them.
+        """
+        return None
+
+    def record_run(self, seconds, threads):
+        """
+        Record the wall time of a run and its number of threads, along with the files
+        encoded since the journal was opened, for the estimates of dry runs.
+        """
+        pass
+
+    def runs(self, limit):
+        """
+        Return the (files, source bytes, seconds, threads) of the last runs, most recent
+        first.
+        """
+        return []
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
     def __contains__(self, item):
         raise NotImplementedError
 
@@ -28,58 +130,341 @@ class BaseJournal:
         raise NotImplementedError
 
 
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS props (
+    id INTEGER PRIMARY KEY,
+    value TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,
+    props_id INTEGER NOT NULL REFERENCES props(id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    props_id INTEGER NOT NULL REFERENCES props(id),
+    mtime_ns INTEGER NOT NULL,
+    subdirs TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS probes (
+    src TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    duration REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hashes (
+    src TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS gains (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    gain REAL NOT NULL,
+    peak REAL NOT NULL,
+    duration REAL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS gains_dir ON gains (dir);
+CREATE TABLE IF NOT EXISTS runs (
+    time REAL NOT NULL,
+    files INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    threads INTEGER NOT NULL
+);
+"""
+
+# Source fingerprint columns, added to journals created before they existed.
+_ENTRY_COLUMNS = (
+    ("size", "INTEGER"),
+    ("mtime_ns", "INTEGER"),
+    ("ino", "INTEGER"),
+    ("hash", "TEXT"),
+    ("kind", "TEXT"),
+    ("alias", "TEXT"),
+)
+
+
 class Journal(BaseJournal):
 
     """
-    This is a log of what has been cloned. In memory, files are kept
-    as absolute paths. In the log file, the paths are saved in relative
-    form. Their root is the destination folder. This permits moving the
-    destination folder around.
+    This is a log of what has been cloned, stored in an SQLite database in WAL mode. Paths
+    are saved in relative form, their root is the destination folder. This permits moving
+    the destination folder around.
+
+    Properties are stored once in their own table and entries refer to them by id. Nothing
+    is loaded up front, lookups go through the primary key index. Additions are committed
+    in batches, once batch_size entries are pending or commit_interval seconds have passed.
+    A crash loses at most the last batch, which only means those files get encoded again.
+
+    Entries made with other properties are dropped when the journal is closed, only if
+    there are any. A journal in the old JSON lines format is imported on first use.
+
+    Each entry records its kind, whether the file was encoded, cloned or copied as is
+    because the source already satisfied the properties. It also records the size, mtime
+    and inode of its source, a changed source is
+    encoded again. With hash_sources, a content hash is recorded as well and a source
+    whose stat changed but whose content did not is left alone. Content hashes are
+    cached by size and mtime. An ALIAS entry also records the entry it is a copy of.
+
+    The journal also keeps a summary of source directories, their mtime and the names of
+    their subdirectories, for fsutil.iter_walk. A directory is only summarized when all
+    of its files were current. Note that editing a file in place does not change the
+    mtime of its directory, such edits are not seen by a walk using the summaries.
+
+    With read_only, the database is copied in memory and never written to, nor created,
+    which is what dry runs use.
     """
 
-    def __init__(self, dest, props):
-        self._log = set()
+    def __init__(self, dest, props, *, batch_size=256, commit_interval=2.0,
+                 hash_sources=False, read_only=False):
+        self._db = None
+        self._hash_sources = hash_sources
+        self._read_only = read_only
+        # Destination directories holding files that were not current during this run.
+        self._dirty = set()
         self._dest = dest.absolute()
         self._props = props
-        p = Path(dest / ".pyaconv")
-        if p.exists():
-            with p.open() as f:
-                for line in f.readlines():
-                    # Parse the line of json and remove the special $path property.
-                    item_props = json.loads(line.rstrip())
-                    path = (dest / Path(item_props.pop("$path"))).absolute()
-                    # Only add log entries that have the same properties.
-                    if compare_props(item_props, props):
-                        self._log.add(path)
-        p.parent.mkdir(parents=True, exist_ok=True)
-        # Override log with valid entries.
-        self._file = p.open('w')
-        for path in self._log:
-            self._write_entry(path)
+        self._batch_size = batch_size
+        self._commit_interval = commit_interval
+        self._pending = 0
+        self._last_commit = time.monotonic()
+        # Files encoded since the journal was opened, for record_run.
+        self._run_files = 0
+        self._run_bytes = 0
+        self._last_src = None
+
+        if read_only:
+            self._db = self._snapshot(dest / ".pyaconv.db")
+        else:
+            dest.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(dest / ".pyaconv.db"))
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(entries)")}
+        for name, kind in _ENTRY_COLUMNS:
+            if name not in columns:
+                self._db.execute("ALTER TABLE entries ADD COLUMN {} {}".format(name, kind))
+
+        self._props_id = self._get_props_id(props)
+        self._import_legacy(Path(dest / ".pyaconv"))
+        self._db.commit()
 
     def __del__(self):
-        self._file.close()
+        self.close()
+
+    @staticmethod
+    def _snapshot(path):
+        db = sqlite3.connect(":memory:")
+        if path.exists():
+            src = sqlite3.connect("{}?mode=ro".format(path.absolute().as_uri()), uri=True)
+            src.backup(db)
+            src.close()
+        return db
+
+    def _get_props_id(self, props):
+        value = _dump_props(props)
+        self._db.execute("INSERT OR IGNORE INTO props (value) VALUES (?)", (value,))
+        row = self._db.execute("SELECT id FROM props WHERE value = ?", (value,)).fetchone()
+        return row[0]
+
+    def _import_legacy(self, p):
+        if not p.exists():
+            return
+        logging.info("importing journal {}", p)
+        with p.open() as f:
+            for line in f:
+                # Parse the line of json and remove the special $path property.
+                item_props = json.loads(line.rstrip())
+                path = item_props.pop("$path")
+                # Only import log entries that have the same properties.
+                if compare_props(item_props, self._props):
+                    self._db.execute("INSERT OR REPLACE INTO entries (path, props_id) "
+                                     "VALUES (?, ?)", (path, self._props_id))
+        self._db.commit()
+        if not self._read_only:
+            p.unlink()
+
+    def _relative(self, path):
+        return str(path.absolute().relative_to(self._dest))
+
+    def _fingerprint(self, src):
+        st = os.stat(str(src))
+        digest = self._source_hash(src, st) if self._hash_sources else None
+        return st.st_size, st.st_mtime_ns, st.st_ino, digest
+
+    def add(self, path, src=None, kind=ENCODED, alias=None):
+        fingerprint = (None, None, None, None)
+        if src is not None:
+            try:
+                fingerprint = self._fingerprint(src)
+            except OSError as e:
+                # E.g. removed or renamed while it was encoded.
+                logging.warning("could not read {}, it will be checked again: {}", src, e)
+                fingerprint = _UNKNOWN_SOURCE
+        if alias is not None:
+            alias = self._relative(alias)
+        self._db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (self._relative(path), self._props_id) + fingerprint +
+                         (kind, alias))
+        if kind == ENCODED and src is not None:
+            self._run_files += 1
+            # The tracks of a cue sheet share their source, it is only read once.
+            if src != self._last_src:
+                self._run_bytes += max(0, fingerprint[0])
+                self._last_src = src
+        self._pending += 1
+        if (self._pending >= self._batch_size or
+                time.monotonic() - self._last_commit >= self._commit_interval):
+            self.commit()
+
+    def commit(self):
+        self._db.commit()
+        self._pending = 0
+        self._last_commit = time.monotonic()
+
+    def check(self, src, dest):
+        rel = self._relative(dest)
+        row = self._db.execute("SELECT props_id, size, mtime_ns, ino, hash FROM entries "
+                               "WHERE path = ?", (rel,)).fetchone()
+        if row is None:
+            reason = NEW
+        elif row[0] != self._props_id:
+            reason = PROPS_CHANGED
+        elif not self._same_source(rel, src, row):
+            reason = SOURCE_CHANGED
+        else:
+            return None
+        self._dirty.add(str(Path(rel).parent))
+        return reason
+
+    def _same_source(self, rel, src, row):
+        _, size, mtime_ns, ino, digest = row
+        # Entries imported from the old journal have no fingerprint.
+        if size is None:
+            return True
+        st = os.stat(str(src))
+        if (st.st_size, st.st_mtime_ns, st.st_ino) == (size, mtime_ns, ino):
+            return True
+        if digest is None or not self._hash_sources or st.st_size != size:
+            return False
+        if self._source_hash(src, st) != digest:
+            return False
+        # Same content, refresh the stat part of the fingerprint.
+        self._db.execute("UPDATE entries SET mtime_ns = ?, ino = ? WHERE path = ?",
+                         (st.st_mtime_ns, st.st_ino, rel))
+        return True
+
+    def unchanged_dir(self, path, mtime_ns):
+        """
+        Return the subdirectory names recorded for a source directory if its mtime did
+        not change, None otherwise.
+        """
+        row = self._db.execute("SELECT props_id, mtime_ns, subdirs FROM dirs WHERE path = ?",
+                               (path,)).fetchone()
+        if row is None or row[0] != self._props_id or row[1] != mtime_ns:
+            return None
+        return json.loads(row[2])
+
+    def record_dir(self, path, mtime_ns, subdirs):
+        if path in self._dirty:
+            self._db.execute("DELETE FROM dirs WHERE path = ?", (path,))
+            return
+        self._db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)",
+                         (path, self._props_id, mtime_ns, json.dumps(subdirs)))
+
+    def cached_duration(self, src, st):
+        row = self._db.execute("SELECT size, mtime_ns, duration FROM probes WHERE src = ?",
+                               (str(src.absolute()),)).fetchone()
+        if row is None or (row[0], row[1]) != (st.st_size, st.st_mtime_ns):
+            return None
+        return row[2]
+
+    def cache_duration(self, src, st, duration):
+        self._db.execute("INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?)",
+                         (str(src.absolute()), st.st_size, st.st_mtime_ns, duration))
+
+    def source_hash(self, src):
+        return self._source_hash(src, os.stat(str(src)))
+
+    def _source_hash(self, src, st):
+        key = str(src.absolute())
+        row = self._db.execute("SELECT size, mtime_ns, hash FROM hashes WHERE src = ?",
+                               (key,)).fetchone()
+        if row is not None and (row[0], row[1]) == (st.st_size, st.st_mtime_ns):
+            return row[2]
+        digest = hash_file(src)
+        self._db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)",
+                         (key, st.st_size, st.st_mtime_ns, digest))
+        return digest
 
-    def add(self, path):
-        self._log.add(path)
-        self._write_entry(path)
+    def find_output(self, digest):
+        rows = self._db.execute("SELECT path FROM entries WHERE hash = ? AND props_id = ? "
+                                "AND kind != ?", (digest, self._props_id, CLONED))
+        for rel, in rows:
+            path = self._dest / rel
+            if path.exists():
+                return path
+        return None
 
-    def _write_entry(self, path):
-        props = self._props.copy()
-        props["$path"] = str(path.absolute().relative_to(self._dest))
-        self._file.write(json.dumps(props))
-        self._file.write("\n")
-        self._file.flush()
+    def record_gain(self, path, gain, peak, duration):
+        rel = self._relative(path)
+        self._db.execute("INSERT OR REPLACE INTO gains VALUES (?, ?, ?, ?, ?)",
+                         (rel, str(Path(rel).parent), gain, peak, duration))
+
+    def dir_gains(self, dir):
+        rows = self._db.execute("SELECT g.path, g.gain, g.peak, g.duration FROM gains g "
+                                "JOIN entries e ON e.path = g.path "
+                                "WHERE g.dir = ? AND e.props_id = ?",
+                                (self._relative(dir), self._props_id))
+        return [(self._dest / rel, gain, peak, duration) for rel, gain, peak, duration in rows]
+
+    def record_run(self, seconds, threads):
+        if not self._run_files:
+            return
+        self._db.execute("INSERT INTO runs VALUES (?, ?, ?, ?, ?)",
+                         (time.time(), self._run_files, self._run_bytes, seconds, threads))
+        self._run_files = 0
+        self._run_bytes = 0
+
+    def runs(self, limit):
+        return self._db.execute("SELECT files, bytes, seconds, threads FROM runs "
+                                "ORDER BY time DESC LIMIT ?", (limit,)).fetchall()
+
+    def compact(self):
+        """
+        Drop the entries made with other properties. Skipped when there are none.
+        """
+        count, = self._db.execute("SELECT COUNT(*) FROM props").fetchone()
+        if count <= 1:
+            return
+        self._db.execute("DELETE FROM entries WHERE props_id != ?", (self._props_id,))
+        self._db.execute("DELETE FROM dirs WHERE props_id != ?", (self._props_id,))
+        self._db.execute("DELETE FROM props WHERE id != ?", (self._props_id,))
+        self._db.commit()
+
+    def close(self):
+        if self._db is None:
+            return
+        self.commit()
+        self.compact()
+        self._db.close()
+        self._db = None
 
     def __contains__(self, path):
         """
         The only entries in the log should be the files that have the same properties
         and that were commited to the log.
         """
-        return path in self._log
+        row = self._db.execute("SELECT props_id FROM entries WHERE path = ?",
+                               (self._relative(path),)).fetchone()
+        return row is not None and row[0] == self._props_id
 
     def __len__(self):
-        return len(self._log)
+        count, = self._db.execute("SELECT COUNT(*) FROM entries WHERE props_id = ?",
+                                  (self._props_id,)).fetchone()
+        return count
 
     def remove_journaled(self, pairs):
         for src, dest in pairs:
@@ -89,17 +474,58 @@ class Journal(BaseJournal):
                 yield (src, dest)
 
 
+class MultiJournal(BaseJournal):
+
+    """
+    Journals of several targets encoded in the same pass. Paths are sequences with a path
+    per target, None for the targets that are skipped.
+    """
+
+    def __init__(self, journals):
+        self.journals = journals
+
+    def add(self, path, src=None, kind=ENCODED, alias=None):
+        for journal, p in zip(self.journals, path):
+            if p is not None:
+                journal.add(p, src, kind)
+
+    def record_run(self, seconds, threads):
+        for journal in self.journals:
+            journal.record_run(seconds, threads)
+
+    def commit(self):
+        for journal in self.journals:
+            journal.commit()
+
+    def close(self):
+        for journal in self.journals:
+            journal.close()
+
+    def __contains__(self, path):
+        return all(p is None or p in journal for journal, p in zip(self.journals, path))
+
+    def __len__(self):
+        return min(len(journal) for journal in self.journals)
+
+    def cached_duration(self, src, st):
+        return self.journals[0].cached_duration(src, st)
+
+    def cache_duration(self, src, st, duration):
+        self.journals[0].cache_duration(src, st, duration)
+
+
 class VoidJournal(BaseJournal):
 
     def __init__(self, dest):
         # Bust the journal if a void journal is used.
-        p = Path(dest / ".pyaconv")
-        try:
-            p.unlink()
-        except FileNotFoundError:
-            pass
+        for name in (".pyaconv", ".pyaconv.db", ".pyaconv.db-wal", ".pyaconv.db-shm"):
+            p = Path(dest / name)
+            try:
+                p.unlink()
+            except FileNotFoundError:
+                pass
 
-    def add(self, path):
+    def add(self, path, src=None, kind=ENCODED, alias=None):
         pass
 
     def __contains__(self, item):
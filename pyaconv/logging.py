@@ -13,8 +13,20 @@ _level_map = {
     ERROR: "ERROR",
 }
 
+_threshold = INFO
+
+
+def set_level(level):
+    """
+    Drop the messages below level, INFO by default.
+    """
+    global _threshold
+    _threshold = level
+
 
 def log(level, fmt, *args, **kwargs):
+    if level < _threshold:
+        return
     fd = sys.stdout if level <= INFO else sys.stderr
     print('{}: {}'.format(_level_map[level], fmt.format(*args, **kwargs)),
           file=fd)
@@ -0,0 +1,171 @@
+"""
+Dry runs: the jobs a run would encode and why, with estimates of the audio duration, the
+output size and the wall time. The journals are read from in-memory copies, nothing is
+written to the destinations, and no pipeline is built, GStreamer is never initialized.
+"""
+import os
+
+from . import fsutil
+from .cost import estimate_duration
+from .journal import NEW, Journal
+from .progress import format_time
+
+# Number of past runs averaged for the wall time estimate.
+HISTORY = 5
+
+
+class PlannedJob:
+
+    """
+    A source that would be encoded, with the destination and the reason of each target
+    that is not current, None for the others.
+    """
+
+    def __init__(self, src, dests, reasons, duration, segment=None):
+        self.src = src
+        self.dests = dests
+        self.reasons = reasons
+        self.duration = duration
+        self.segment = segment
+
+    def to_dict(self):
+        return {
+            "src": str(self.src),
+            "dests": [None if d is None else str(d) for d in self.dests],
+            "reasons": self.reasons,
+            "duration": self.duration,
+            "track": None if self.segment is None else self.segment.tags["number"],
+        }
+
+
+class Plan:
+
+    """
+    The jobs of a dry run and their totals. sizes holds the estimated output bytes of each
+    target, None when the codec cannot tell. seconds is the estimated wall time, None
+    without the history of an earlier run.
+    """
+
+    def __init__(self, codecs, jobs, duration, source_bytes, sizes, seconds):
+        self.codecs = codecs
+        self.jobs = jobs
+        self.duration = duration
+        self.source_bytes = source_bytes
+        self.sizes = sizes
+        self.seconds = seconds
+
+    def to_dict(self):
+        return {
+            "codecs": self.codecs,
+            "jobs": [job.to_dict() for job in self.jobs],
+            "files": len(self.jobs),
+            "duration": self.duration,
+            "source_bytes": self.source_bytes,
+            "sizes": dict(zip(self.codecs, self.sizes)),
+            "seconds": self.seconds,
+        }
+
+    def lines(self):
+        """
+        Yield the plan as text, a line per job followed by the totals.
+        """
+        multi = len(self.codecs) > 1
+        for job in self.jobs:
+            for codec, dest, reason in zip(self.codecs, job.dests, job.reasons):
+                if dest is None:
+                    continue
+                prefix = "{}: ".format(codec) if multi else ""
+                yield "{}{:<14} {} -> {}".format(prefix, reason, job.src, dest)
+        yield "{} files, {} of audio, {:.1f} MB of sources".format(
+            len(self.jobs), format_time(self.duration), self.source_bytes / 1e6)
+        for codec, size in zip(self.codecs, self.sizes):
+            if size is not None:
+                yield "{}: about {:.1f} MB of output".format(codec, size / 1e6)
+        if self.seconds is not None:
+            yield "estimated time {}".format(format_time(self.seconds))
+        else:
+            yield "estimated time unknown, no earlier run recorded"
+
+
+def _wall_time(journal, source_bytes, threads):
+    # Thread seconds per source byte over the last runs, spread over the threads.
+    runs = journal.runs(HISTORY)
+    busy = sum(seconds * run_threads for _, _, seconds, run_threads in runs)
+    read = sum(size for _, size, _, _ in runs)
+    if not read:
+        return None
+    return source_bytes * busy / read / threads
+
+
+def plan(targets, src_dir, *, incremental=True, hash_sources=False, fast_scan=False,
+         sniff=False, scan_threads=None, split_cue=False, threads=1):
+    """
+    Walk src_dir like a run would and return a Plan of what it would encode. targets is
+    a list of (codec name, encoder, props, dest_dir), as Converter.targets.
+
+    Durations come from the probes cached in the journal or, for files never probed, from
+    their size and extension. Passthrough and dedup are not taken into account, the files they would
+    skip are listed as encoded.
+    """
+    src_dir = fsutil.Path(src_dir)
+    journals = []
+    if incremental:
+        journals = [Journal(dest, props, hash_sources=hash_sources, read_only=True)
+                    for _, _, props, dest in targets]
+    try:
+        _, encoder, _, dest_dir = targets[0]
+        summaries = journals[0] if fast_scan and journals and len(targets) == 1 else None
+        entries = fsutil.iter_walk(src_dir, dest_dir, encoder.extension(),
+                                   summaries=summaries, sniff=sniff, threads=scan_threads,
+                                   split_cue=split_cue)
+
+        jobs = []
+        duration = 0.0
+        source_bytes = 0
+        last_src = None
+        src_duration = None
+        for src, clone_path, is_audio in entries:
+            if not is_audio:
+                continue
+            rel = clone_path.relative_to(dest_dir)
+            dests = []
+            reasons = []
+            for i, (_, enc, _, target_dir) in enumerate(targets):
+                target = (target_dir / rel).with_suffix("." + enc.extension())
+                reason = journals[i].check(src, target) if journals else NEW
+                dests.append(None if reason is None else target)
+                reasons.append(reason)
+            if all(d is None for d in dests):
+                continue
+
+            # The tracks of a cue sheet share their source, it is only read once.
+            if src != last_src:
+                st = os.stat(str(src))
+                src_duration = journals[0].cached_duration(src, st) if journals else None
+                if src_duration is None:
+                    src_duration = estimate_duration(src, st.st_size)
+                source_bytes += st.st_size
+                last_src = src
+            segment = None if is_audio is True else is_audio
+            job_duration = src_duration
+            if segment is not None:
+                job_duration = segment.length
+                if job_duration is None:
+                    job_duration = max(0.0, src_duration - segment.start)
+            duration += job_duration
+            jobs.append(PlannedJob(src, dests, reasons, job_duration, segment))
+
+        sizes = []
+        for i, (_, enc, props, _) in enumerate(targets):
+            bitrate = enc.bitrate(props)
+            if bitrate is None:
+                sizes.append(None)
+                continue
+            seconds = sum(job.duration for job in jobs if job.dests[i] is not None)
+            sizes.append(int(bitrate * seconds / 8))
+        seconds = _wall_time(journals[0], source_bytes, threads) if journals else None
+        return Plan([name for name, _, _, _ in targets], jobs, duration, source_bytes,
+                    sizes, seconds)
+    finally:
+        for journal in journals:
+            journal.close()
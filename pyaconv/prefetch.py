@@ -0,0 +1,83 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+from . import logging
+
+
+def warm(path, read=False, chunk_size=1 << 20):
+    """
+    Get the content of path into the page cache. By default the kernel is asked to read it
+    ahead with posix_fadvise, with read or where that is not available, the file is read
+    sequentially and the data discarded, which also works on network filesystems that
+    ignore the advice. Return the number of bytes read.
+    """
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError as e:
+        logging.debug("could not prefetch {}: {}", path, e)
+        return 0
+    try:
+        if not read and hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            return 0
+        total = 0
+        while True:
+            data = os.read(fd, chunk_size)
+            if not data:
+                return total
+            total += len(data)
+    except OSError as e:
+        logging.debug("could not prefetch {}: {}", path, e)
+        return 0
+    finally:
+        os.close(fd)
+
+
+class Prefetcher:
+
+    """
+    Wraps an iterator of jobs and warms the sources of the next depth jobs in a thread pool
+    while the current ones are encoded, so that filesrc finds them in the page cache
+    instead of waiting on a NAS or a seeking disk. Jobs are pulled ahead until depth of
+    them are held or their sources add up to budget bytes.
+
+    Pulling ahead also walks the source tree ahead, the order of the jobs is unchanged.
+    """
+
+    def __init__(self, jobs, depth=4, budget=512 << 20, read=False, threads=2):
+        self._jobs = iter(jobs)
+        self._depth = depth
+        self._budget = budget
+        self._read = read
+        self._ahead = deque()
+        self._bytes = 0
+        self._pool = ThreadPoolExecutor(threads)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self._fill()
+        if not self._ahead:
+            self._pool.shutdown(wait=False)
+            raise StopIteration
+        job, size = self._ahead.popleft()
+        self._bytes -= size
+        self._fill()
+        return job
+
+    def _fill(self):
+        while len(self._ahead) < self._depth and (not self._ahead or
+                                                  self._bytes < self._budget):
+            job = next(self._jobs, None)
+            if job is None:
+                return
+            src = job[0]
+            try:
+                size = os.stat(str(src)).st_size
+            except OSError:
+                size = 0
+            self._pool.submit(warm, src, self._read)
+            self._ahead.append((job, size))
+            self._bytes += size
@@ -0,0 +1,209 @@
+"""
+Per-stage profiling of the pipelines, to tell whether a run is bound by decoding,
+resampling, encoding or storage.
+
+Buffer probes are added on the pads of every element of the pipelines, including the ones
+decodebin creates. GStreamer elements push synchronously within a streaming thread, so the
+time between two probes of the same thread belongs to the element that was running: from
+a buffer entering an element to the element pushing a buffer out, or to a buffer entering
+the next element. The time after a sink consumed a buffer, until the source of the thread
+pushes the next one, covers both the write and the read, it is charged to the source, in
+the "io" stage like the sink. Events reset the clock of their thread, the time spent
+waiting between files or in queues is not counted. In the threads of queues, e.g. the
+branches of several codecs, writes cannot be told apart from waiting and are not counted
+either.
+
+The probes run Python code for every buffer of every element, a profiled run is slower,
+the shares of the stages are what matters.
+"""
+import json
+import threading
+import time
+
+from gi.repository import Gst
+
+from . import logging
+
+# Stages of elements told apart by their factory, the others go by their klass.
+_FACTORY_STAGES = {
+    "audioresample": "resample",
+    "audioconvert": "convert",
+    "rganalysis": "replaygain",
+}
+_KLASS_STAGES = (
+    ("Source", "io"),
+    ("Sink", "io"),
+    ("Demuxer", "decode"),
+    ("Parser", "decode"),
+    ("Decoder", "decode"),
+    ("Encoder", "encode"),
+    ("Muxer", "encode"),
+    ("Formatter", "encode"),
+)
+# Elements whose streaming threads wait for data, the time before they push is idle time.
+_QUEUES = frozenset(("queue", "queue2", "multiqueue"))
+
+
+def _describe(elem):
+    factory = elem.get_factory()
+    if factory is None:
+        return None, None
+    name = factory.get_name()
+    if name in _FACTORY_STAGES:
+        return name, _FACTORY_STAGES[name]
+    klass = factory.get_metadata("klass") or ""
+    for word, stage in _KLASS_STAGES:
+        if word in klass.split("/"):
+            return name, stage
+    return name, "other"
+
+
+class _Stats:
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.seconds = 0.0
+        self.buffers = 0
+        self.bytes = 0
+
+
+class Profiler:
+
+    """
+    Aggregates the time spent in each element, and the buffers and bytes they push, or
+    consume for sinks, over all the pipelines it is attached to, see attach. The elements
+    are grouped by factory name, e.g. "opusenc", and by stage: io, decode, convert,
+    resample, encode, replaygain. A single Profiler is shared by all the workers, the
+    probes are called from the streaming threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        # factory name -> _Stats
+        self._elements = {}
+        # thread id -> [time of the last probe, stack of the (element, stats) running]
+        self._threads = {}
+
+    def attach(self, enc):
+        """
+        Probe the elements of an encoder, and the ones added to it later on.
+        """
+        enc.watch_elements(self._instrument)
+
+    def _instrument(self, elem):
+        if isinstance(elem, Gst.Bin):
+            return
+        name, stage = _describe(elem)
+        if name is None:
+            return
+        with self._lock:
+            stats = self._elements.setdefault(name, _Stats(stage))
+        # Elements of the same factory share their stats, the stacks tell them apart.
+        sink = all(pad.get_direction() == Gst.PadDirection.SINK for pad in elem.pads)
+        running = (object(), stats, sink)
+        kinds = Gst.PadProbeType.BUFFER | Gst.PadProbeType.EVENT_DOWNSTREAM
+        for pad in elem.pads:
+            if pad.get_direction() == Gst.PadDirection.SINK:
+                pad.add_probe(kinds, self._on_sink, running)
+            else:
+                pad.add_probe(kinds, self._on_src, running, name)
+
+    def _thread(self, now):
+        state = self._threads.get(threading.get_ident())
+        if state is None:
+            state = self._threads[threading.get_ident()] = [now, []]
+        return state
+
+    def _charge(self, state, now, stats):
+        if stats is not None:
+            stats.seconds += now - state[0]
+        state[0] = now
+
+    def _on_sink(self, pad, info, running):
+        now = time.perf_counter()
+        with self._lock:
+            state = self._thread(now)
+            if info.type & Gst.PadProbeType.BUFFER:
+                stack = state[1]
+                # The element that pushed the buffer ran until now.
+                self._charge(state, now, stack[-1][1] if stack else None)
+                stack.append(running)
+                if running[2]:
+                    self._count(running[1], info)
+            else:
+                state[0] = now
+                state[1] = []
+        return Gst.PadProbeReturn.OK
+
+    def _on_src(self, pad, info, running, name):
+        now = time.perf_counter()
+        with self._lock:
+            state = self._thread(now)
+            if not info.type & Gst.PadProbeType.BUFFER:
+                state[0] = now
+                state[1] = []
+                return Gst.PadProbeReturn.OK
+            stack = state[1]
+            stats = running[1]
+            if name in _QUEUES:
+                # The queue waited for data, or for the branch to take more.
+                state[0] = now
+                state[1] = [running]
+            else:
+                if running in stack:
+                    # The elements downstream of this one have returned.
+                    del stack[stack.index(running) + 1:]
+                else:
+                    # The source of the thread, its first buffer since an event.
+                    state[1] = [running]
+                self._charge(state, now, stats)
+            self._count(stats, info)
+        return Gst.PadProbeReturn.OK
+
+    def _count(self, stats, info):
+        buf = info.get_buffer()
+        stats.buffers += 1
+        stats.bytes += buf.get_size() if buf is not None else 0
+
+    def summary(self):
+        """
+        Return a dict with the elapsed time, and the seconds, share of the measured time,
+        buffers and bytes pushed of each stage and each element.
+        """
+        with self._lock:
+            elements = {name: {"stage": s.stage, "seconds": s.seconds, "buffers": s.buffers,
+                               "bytes": s.bytes}
+                        for name, s in self._elements.items()}
+        stages = {}
+        for stats in elements.values():
+            stage = stages.setdefault(stats["stage"], {"seconds": 0.0, "buffers": 0,
+                                                       "bytes": 0})
+            for key in ("seconds", "buffers", "bytes"):
+                stage[key] += stats[key]
+        total = sum(s["seconds"] for s in stages.values())
+        for stats in list(elements.values()) + list(stages.values()):
+            stats["share"] = stats["seconds"] / total if total > 0 else 0.0
+        return {
+            "elapsed": time.monotonic() - self._start,
+            "seconds": total,
+            "stages": stages,
+            "elements": elements,
+        }
+
+    def report(self, path=None):
+        """
+        Log the summary, busiest stage first, and write it as JSON to path if given.
+        """
+        summary = self.summary()
+        logging.info("profile of {:.1f}s of element time:", summary["seconds"])
+        for name, s in sorted(summary["stages"].items(), key=lambda i: -i[1]["seconds"]):
+            logging.info("{:<12} {:5.1%} {:9.2f}s", name, s["share"], s["seconds"])
+        for name, s in sorted(summary["elements"].items(), key=lambda i: -i[1]["seconds"]):
+            rate = s["bytes"] / s["seconds"] / 1e6 if s["seconds"] > 0 else 0.0
+            logging.info("  {:<16} {:<10} {:5.1%} {:9.2f}s {:9} buffers {:8.1f} MB/s",
+                         name, s["stage"], s["share"], s["seconds"], s["buffers"], rate)
+        if path is not None:
+            with open(str(path), "w") as f:
+                json.dump(summary, f, indent=2, sort_keys=True)
+        return summary
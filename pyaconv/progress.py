@@ -0,0 +1,135 @@
+import json
+import os
+import time
+
+from . import logging
+
+
+def format_time(time):
+    hours, rem = divmod(time, 3600)
+    mins, secs = divmod(rem, 60)
+    return "{:02}:{:02}:{:02}".format(int(hours), int(mins), int(secs))
+
+
+class _Running:
+
+    def __init__(self, src, size, encoder):
+        self.src = src
+        self.size = size
+        self.encoder = encoder
+        self.started = time.monotonic()
+
+
+class Progress:
+
+    """
+    Keeps track of the files being encoded and derives throughput metrics from them: files
+    done and remaining, source bytes per second, encoded audio seconds per wall second for
+    each worker and an ETA. The total is unknown while the source tree is still being
+    walked, it is settled once the workers run out of jobs, unless given up front. Jobs
+    started afterwards, e.g. submitted to a scheduler kept alive, add to it.
+
+    Snapshots are logged and, when snapshot_path is set, written to that file as JSON.
+    """
+
+    def __init__(self, total=None, snapshot_path=None):
+        self._start = time.monotonic()
+        self._total = total
+        self._snapshot_path = snapshot_path
+        self._done = 0
+        self._bytes = 0
+        self._running = {}
+        # worker -> [audio seconds encoded, wall seconds spent encoding]
+        self._workers = {}
+
+    def start(self, worker, src, encoder=None):
+        """
+        Called when a worker starts on a file. Without an encoder, only files and bytes
+        are accounted for, worker is then any key identifying the job.
+        """
+        try:
+            size = os.stat(str(src)).st_size
+        except OSError:
+            size = 0
+        self._running[worker] = _Running(src, size, encoder)
+        if self._total is not None:
+            self._total = max(self._total, self._done + len(self._running))
+        if encoder is not None:
+            self._workers.setdefault(worker, [0.0, 0.0])
+
+    def finish(self, worker):
+        job = self._running.pop(worker, None)
+        self._done += 1
+        if job is None:
+            return
+        self._bytes += job.size
+        if job.encoder is None:
+            return
+        wall = time.monotonic() - job.started
+        audio = job.encoder.duration()
+        stats = self._workers[worker]
+        stats[1] += wall
+        if audio is not None:
+            stats[0] += audio
+            if wall > 0:
+                logging.debug("encoded {} in {:.1f}s, {:.1f}x realtime", job.src, wall,
+                              audio / wall)
+
+    def cancel(self, worker):
+        """
+        Called when a job is given up before it is done, e.g. to run it elsewhere.
+        """
+        self._running.pop(worker, None)
+
+    def exhausted(self):
+        """
+        Called when there are no more jobs to hand out, the total is now known.
+        """
+        if self._total is None:
+            self._total = self._done + len(self._running)
+
+    def snapshot(self):
+        elapsed = time.monotonic() - self._start
+        workers = {}
+        for worker, (audio, wall) in self._workers.items():
+            job = self._running.get(worker)
+            if job is not None and job.encoder is not None:
+                # Account for the file in flight.
+                audio += job.encoder.position() or 0.0
+                wall += time.monotonic() - job.started
+            workers[str(worker)] = audio / wall if wall > 0 else None
+
+        rate = self._done / elapsed if elapsed > 0 else 0.0
+        remaining = None
+        eta = None
+        if self._total is not None:
+            remaining = max(0, self._total - self._done)
+            if rate > 0:
+                eta = remaining / rate
+        return {
+            "time": time.time(),
+            "elapsed": elapsed,
+            "done": self._done,
+            "running": len(self._running),
+            "remaining": remaining,
+            "files_per_second": rate,
+            "bytes_per_second": self._bytes / elapsed if elapsed > 0 else 0.0,
+            "realtime_factor": workers,
+            "eta": eta,
+        }
+
+    def report(self):
+        snap = self.snapshot()
+        factors = [f for f in snap["realtime_factor"].values() if f is not None]
+        logging.info("{} done, {} remaining, {:.1f} MB/s, {:.1f}x realtime per worker, "
+                     "eta {}", snap["done"],
+                     "?" if snap["remaining"] is None else snap["remaining"],
+                     snap["bytes_per_second"] / 1e6,
+                     sum(factors) / len(factors) if factors else 0.0,
+                     "?" if snap["eta"] is None else format_time(snap["eta"]))
+        if self._snapshot_path is not None:
+            tmp = "{}.tmp".format(self._snapshot_path)
+            with open(tmp, "w") as f:
+                json.dump(snap, f)
+            os.replace(tmp, str(self._snapshot_path))
+        return snap
@@ -0,0 +1,111 @@
+import math
+
+from . import logging
+
+try:
+    import mutagen
+    from mutagen.oggopus import OggOpus
+except ImportError:
+    mutagen = None
+
+
+def available():
+    """
+    Return whether tags can be written, which needs the mutagen package.
+    """
+    return mutagen is not None
+
+
+# ReplayGain targets 89 dB SPL, about -18 LUFS, R128 gains are relative to -23 LUFS.
+_R128_OFFSET = -5.0
+
+
+def _format_tags(kind, gain, peak, opus=False):
+    # Opus players ignore the ReplayGain tags, RFC 7845 uses R128 gains in Q7.8 instead.
+    if opus:
+        q78 = int(round((gain + _R128_OFFSET) * 256))
+        return {"r128_{}_gain".format(kind): str(max(-32768, min(32767, q78)))}
+    return {
+        "replaygain_{}_gain".format(kind): "{:.2f} dB".format(gain),
+        "replaygain_{}_peak".format(kind): "{:.6f}".format(peak),
+    }
+
+
+def write_gain(path, kind, gain, peak):
+    """
+    Write the "track" or "album" gain and peak tags of path, R128 tags for Opus files.
+    """
+    audio = mutagen.File(str(path), easy=True)
+    if audio is None:
+        raise ValueError("unsupported format")
+    if audio.tags is None:
+        audio.add_tags()
+    for key, value in _format_tags(kind, gain, peak, isinstance(audio, OggOpus)).items():
+        audio[key] = value
+    audio.save()
+
+
+def album_gain(tracks):
+    """
+    Return the (gain, peak) of an album from the (gain, peak, duration) of its tracks.
+    The loudness of each track is averaged in the energy domain, weighted by its duration.
+    This approximates the gain of an analysis of the whole album, which would need the
+    samples of every track in a single pass.
+    """
+    weights = [duration or 1.0 for _, _, duration in tracks]
+    energy = sum(w * 10 ** (-gain / 10) for w, (gain, _, _) in zip(weights, tracks))
+    return -10 * math.log10(energy / sum(weights)), max(peak for _, peak, _ in tracks)
+
+
+class ReplayGain:
+
+    """
+    Collects the track gains of the files encoded by the Workers. Track gain and peak tags
+    are written as soon as a file is encoded, album tags are written by finish, once
+    every file is in place. The tracks of a destination directory make an album, the
+    gains recorded by the journals in previous runs are included. journals holds a
+    journal per destination, for the several destinations of a MultiEncoder.
+
+    Tags are rewritten in place, the outputs must not be hard links shared with other
+    files, as dedup makes.
+    """
+
+    def __init__(self, journals):
+        self._journals = journals
+        # (destination index, destination directory) -> [(path, gain, peak, duration)]
+        self._dirs = {}
+
+    def _write(self, path, kind, gain, peak):
+        try:
+            write_gain(path, kind, gain, peak)
+        except (OSError, ValueError, mutagen.MutagenError) as e:
+            logging.error("could not write ReplayGain tags to {}: {}", path, e)
+            return False
+        return True
+
+    def track(self, dest, written, gain, duration):
+        """
+        Called when dest is encoded, written is where the file is for now.
+        """
+        if gain is None:
+            logging.warning("no ReplayGain analysis for {}", dest)
+            return
+        track_gain, peak = gain
+        if not isinstance(dest, tuple):
+            dest, written = (dest,), (written,)
+        for i, (d, w) in enumerate(zip(dest, written)):
+            if d is None or not self._write(w, "track", track_gain, peak):
+                continue
+            d = d.absolute()
+            self._journals[i].record_gain(d, track_gain, peak, duration)
+            self._dirs.setdefault((i, d.parent), []).append((d, track_gain, peak, duration))
+
+    def finish(self):
+        for (i, dir), tracks in self._dirs.items():
+            tracks = self._journals[i].dir_gains(dir) or tracks
+            gain, peak = album_gain([track[1:] for track in tracks])
+            logging.info("album gain of {} is {:.2f} dB", dir, gain)
+            for path, _, _, _ in tracks:
+                if path.exists():
+                    self._write(path, "album", gain, peak)
+        self._dirs = {}
@@ -0,0 +1,104 @@
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import os
+import queue
+import shutil
+import tempfile
+
+from . import fsutil, logging
+from .fsutil import Path
+
+
+class Stager:
+
+    """
+    Pipelines write to a local staging directory, e.g. on tmpfs or an SSD, instead of the
+    destination. Finished files are moved to the destination by a pool of mover threads
+    and only journaled once they are in place, the encoders never wait on a slow
+    destination and a killed run leaves no truncated file under a journaled name.
+
+    The journal belongs to the thread running the main loop, moved files are queued and
+    journaled by drain, which is meant to be called from a GLib timer. Files that could
+    not be moved are given to failed_cb, if set, with their (src, dest) job and the error,
+    also from drain.
+    """
+
+    def __init__(self, stage_dir, journal, threads=2, failed_cb=None):
+        stage_dir.mkdir(parents=True, exist_ok=True)
+        # A directory of its own, concurrent runs may share the staging directory.
+        self._dir = Path(tempfile.mkdtemp(prefix="pyaconv-", dir=str(stage_dir)))
+        self._journal = journal
+        self._failed_cb = failed_cb
+        self._pool = ThreadPoolExecutor(threads)
+        self._moved = queue.Queue()
+        self._names = itertools.count()
+        self._aborted = False
+
+    def stage(self, dest):
+        """
+        Return the staging path of dest, or a tuple of them for a tuple of destinations.
+        """
+        if isinstance(dest, tuple):
+            return tuple(self.stage(d) for d in dest)
+        if dest is None:
+            return None
+        return self._dir / "{}{}".format(next(self._names), dest.suffix)
+
+    def move(self, staged, dest, src):
+        self._pool.submit(self._move, staged, dest, src)
+
+    def discard(self, staged):
+        for path in staged if isinstance(staged, tuple) else (staged,):
+            if path is not None:
+                try:
+                    os.unlink(str(path))
+                except FileNotFoundError:
+                    pass
+
+    def _move(self, staged, dest, src):
+        if self._aborted:
+            self.discard(staged)
+            return
+        if isinstance(dest, tuple):
+            pairs = list(zip(staged, dest))
+        else:
+            pairs = [(staged, dest)]
+        try:
+            for s, d in pairs:
+                if s is not None:
+                    fsutil.move_file(s, d)
+        except OSError as e:
+            # Not journaled, the file is encoded again on the next run.
+            logging.error("could not move {} to {}: {}", src, dest, e)
+            self.discard(staged)
+            self._moved.put((dest, src, str(e)))
+            return
+        self._moved.put((dest, src, None))
+
+    def abort(self):
+        """
+        Drop the moves that have not started, and the files moved but not journaled yet.
+        """
+        self._aborted = True
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def drain(self):
+        if self._aborted:
+            return True
+        while True:
+            try:
+                dest, src, error = self._moved.get_nowait()
+            except queue.Empty:
+                return True
+            if error is None:
+                self._journal.add(dest, src)
+            elif self._failed_cb is not None:
+                self._failed_cb((src, dest), error)
+
+    def close(self):
+        """
+        Wait for the moves in flight, journal them and remove the staging directory.
+        """
+        self._pool.shutdown(wait=True)
+        self.drain()
+        shutil.rmtree(str(self._dir), ignore_errors=True)
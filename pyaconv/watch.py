@@ -0,0 +1,135 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+import time
+
+from gi.repository import GLib
+
+from . import logging
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+_EVENT = struct.Struct("iIII")
+
+_libc = None
+
+
+def _inotify():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    return _libc
+
+
+class Watcher:
+
+    """
+    Watches a source tree with inotify from the GLib main loop. Changes are debounced per
+    directory: once a directory has been quiet for debounce seconds, on_change is called
+    with it and whether it must be walked recursively, which is the case for new
+    directories. On a queue overflow, the whole tree is reported.
+    """
+
+    def __init__(self, root, on_change, debounce=2.0):
+        self._root = root
+        self._on_change = on_change
+        self._debounce = debounce
+        self._fd = None
+        self._wds = {}
+        # directory -> [recursive, time of the last event]
+        self._pending = {}
+        self._sources = []
+        self._timer = None
+
+    def start(self):
+        libc = _inotify()
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._add_tree(str(self._root))
+        self._sources.append(GLib.io_add_watch(self._fd, GLib.PRIORITY_DEFAULT,
+                                               GLib.IOCondition.IN, self._read))
+
+    def stop(self):
+        for source in self._sources:
+            GLib.source_remove(source)
+        if self._timer is not None:
+            GLib.source_remove(self._timer)
+            self._timer = None
+        self._sources = []
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _add_watch(self, path):
+        wd = _inotify().inotify_add_watch(self._fd, os.fsencode(path), _WATCH_MASK)
+        if wd < 0:
+            logging.warning("could not watch {}: {}", path, os.strerror(ctypes.get_errno()))
+            return
+        self._wds[wd] = path
+
+    def _add_tree(self, path):
+        for dir, _, _ in os.walk(path):
+            self._add_watch(dir)
+
+    def _read(self, fd, condition):
+        try:
+            data = os.read(fd, 64 * 1024)
+        except BlockingIOError:
+            return True
+        now = time.monotonic()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("inotify queue overflow, rescanning {}", self._root)
+                self._mark(str(self._root), True, now)
+                continue
+            dir = self._wds.get(wd)
+            if dir is None:
+                continue
+            path = os.path.join(dir, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                # A new directory, watch it and walk it, it may already hold files.
+                self._add_tree(path)
+                self._mark(path, True, now)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self._mark(dir, False, now)
+
+        if self._pending and self._timer is None:
+            self._timer = GLib.timeout_add(int(self._debounce * 500), self._flush)
+        return True
+
+    def _mark(self, dir, recursive, now):
+        pending = self._pending.setdefault(dir, [False, now])
+        pending[0] = pending[0] or recursive
+        pending[1] = now
+
+    def _flush(self):
+        now = time.monotonic()
+        ready = [(dir, recursive) for dir, (recursive, last) in self._pending.items()
+                 if now - last >= self._debounce]
+        for dir, _ in ready:
+            del self._pending[dir]
+        # The timer is rearmed even if on_change raises, or the changes to come are lost.
+        self._timer = None
+        try:
+            if ready:
+                self._on_change(ready)
+        finally:
+            if self._pending and self._timer is None:
+                self._timer = GLib.timeout_add(int(self._debounce * 500), self._flush)
+        return False
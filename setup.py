@@ -3,9 +3,14 @@ from setuptools import setup, find_packages
 setup(
     name='pyaconv',
     packages=find_packages(),
+    extras_require={
+        'replaygain': ['mutagen'],
+    },
     entry_points={
         'console_scripts': [
-            'pyaconv=pyaconv.__main__:main'
+            'pyaconv=pyaconv.__main__:main',
+            'pyaconv-bench=pyaconv.bench:main',
+            'pyaconv-agent=pyaconv.distributed:main',
         ]
     }
 )